@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+# coding: utf-8
+#
+# Usage: python3 benchmarks/bench.py --objects 10000 -o results.json
+#
+# Requires lglass_sql to be importable and initdb/pg_ctl on the PATH.
+
+import argparse
+import contextlib
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import psycopg2 as pg
+import psycopg2.extensions
+
+import lglass_sql.nic
+
+SCHEMA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..",
+                      "schema.sql")
+
+
+@contextlib.contextmanager
+def temporary_cluster(port, keep=False):
+    directory = tempfile.mkdtemp(prefix="lglass-sql-bench-")
+    data = os.path.join(directory, "data")
+    subprocess.run(["initdb", "-D", data, "-A", "trust", "-U", "postgres",
+                    "--no-sync"], check=True, stdout=subprocess.DEVNULL)
+    subprocess.run(["pg_ctl", "-D", data, "-w", "-l",
+                    os.path.join(directory, "postgres.log"), "-o",
+                    "-k {} -c listen_addresses='' -p {} -c fsync=off".format(
+                        directory, port), "start"],
+                   check=True, stdout=subprocess.DEVNULL)
+    try:
+        yield "host={} port={} user=postgres".format(directory, port)
+    finally:
+        subprocess.run(["pg_ctl", "-D", data, "-w", "-m", "fast", "stop"],
+                       stdout=subprocess.DEVNULL)
+        if not keep:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+def create_database(dsn, name):
+    conn = pg.connect(dsn + " dbname=postgres")
+    conn.set_isolation_level(pg.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+    with conn.cursor() as cur:
+        cur.execute("CREATE DATABASE {}".format(name))
+    conn.close()
+    conn = pg.connect(dsn + " dbname=" + name)
+    with conn.cursor() as cur, open(SCHEMA) as schema:
+        cur.execute(schema.read())
+    conn.commit()
+    conn.close()
+    return dsn + " dbname=" + name
+
+
+def generate_registry(size, rnd):
+    maintainers = ["BENCH{}-MNT".format(n) for n in range(max(1, size // 100))]
+    persons = ["BP{}-BENCH".format(n) for n in range(max(1, size // 20))]
+    for mnt in maintainers:
+        yield [("mntner", mnt), ("admin-c", rnd.choice(persons)),
+               ("auth", "PGPKEY-00000000"), ("mnt-by", mnt),
+               ("source", "BENCH")]
+    for handle in persons:
+        yield [("person", "Bench Person " + handle), ("address", "Nowhere"),
+               ("nic-hdl", handle), ("mnt-by", rnd.choice(maintainers)),
+               ("source", "BENCH")]
+    yield [("as-block", "AS64512 - AS65534"),
+           ("mnt-by", rnd.choice(maintainers)), ("source", "BENCH")]
+    for n in range(size):
+        a, b = divmod(n, 256)
+        mnt = rnd.choice(maintainers)
+        yield [("inetnum", "10.{}.{}.0 - 10.{}.{}.255".format(a % 256, b,
+                                                            a % 256, b)),
+               ("netname", "BENCH-NET-{}".format(n)),
+               ("admin-c", rnd.choice(persons)),
+               ("tech-c", rnd.choice(persons)), ("mnt-by", mnt),
+               ("remarks", "synthetic benchmark network"),
+               ("source", "BENCH")]
+        yield [("route", "10.{}.{}.0/24".format(a % 256, b)),
+               ("origin", "AS{}".format(64512 + n % 1000)),
+               ("mnt-by", mnt), ("source", "BENCH")]
+        yield [("domain", "{}.{}.10.in-addr.arpa".format(b, a % 256)),
+               ("nserver", "ns.example.net"), ("mnt-by", mnt),
+               ("source", "BENCH")]
+
+
+def percentile(samples, fraction):
+    if not samples:
+        return None
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+def measure(name, func, args_iter, results):
+    latencies = []
+    start = time.perf_counter()
+    for args in args_iter:
+        t = time.perf_counter()
+        func(*args)
+        latencies.append(time.perf_counter() - t)
+    elapsed = time.perf_counter() - start
+    results[name] = {
+        "operations": len(latencies),
+        "throughput": len(latencies) / elapsed if elapsed else None,
+        "p50_ms": None,
+        "p99_ms": None
+    }
+    if not latencies:
+        print("{:<16} {:>8} ops".format(name, 0), file=sys.stderr)
+        return
+    results[name]["p50_ms"] = percentile(latencies, 0.5) * 1000
+    results[name]["p99_ms"] = percentile(latencies, 0.99) * 1000
+    print("{:<16} {:>8} ops {:>10.1f} ops/s p50 {:>8.3f} ms "
+          "p99 {:>8.3f} ms".format(name, len(latencies),
+                                   results[name]["throughput"],
+                                   results[name]["p50_ms"],
+                                   results[name]["p99_ms"]),
+          file=sys.stderr)
+
+
+def run(dsn, size, iterations, seed):
+    rnd = random.Random(seed)
+    # Pooled, so that timings measure queries and not connection setup
+    db = lglass_sql.nic.NicDatabase(dsn, database_name="bench",
+                                    implicit_pool=True)
+    try:
+        return _run(db, size, iterations, rnd)
+    finally:
+        db.close()
+
+
+def _run(db, size, iterations, rnd):
+    objs = [db.create_object(lines) for lines in generate_registry(size, rnd)]
+    results = {}
+    measure("save", db.save, ((obj,) for obj in objs), results)
+    specs = [db.primary_spec(obj) for obj in objs]
+    routes = [obj for obj in objs if obj.object_class == "route"]
+    mnts = [obj.primary_key for obj in objs
+            if obj.object_class == "mntner"]
+    measure("fetch", db.fetch,
+            (rnd.choice(specs) for _ in range(iterations)), results)
+    measure("find", lambda: db.find(classes=["mntner"]),
+            (() for _ in range(max(1, iterations // 100))), results)
+    measure("search_inverse",
+            lambda mnt: db.search_inverse(["mnt-by"], [mnt]),
+            ((rnd.choice(mnts),)
+             for _ in range(max(1, iterations // 10))), results)
+
+    def random_address():
+        net = rnd.choice(routes).ip_network
+        return (str(net.network_address + rnd.randrange(net.num_addresses)),)
+    measure("lookup_route", db.lookup_route,
+            (random_address() for _ in range(iterations)), results)
+    measure("lookup_inetnum", db.lookup_inetnum,
+            (random_address() for _ in range(iterations)), results)
+    measure("lookup_as_block", db.lookup_as_block,
+            ((rnd.randint(64512, 65534),) for _ in range(iterations)),
+            results)
+    measure("lookup_domain", db.lookup_domain,
+            (("{}.{}.10.in-addr.arpa".format(rnd.randrange(256),
+                                             rnd.randrange(256)),)
+             for _ in range(iterations)), results)
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], check=True, capture_output=True,
+            cwd=os.path.dirname(SCHEMA), text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark lglass_sql against a throwaway PostgreSQL")
+    parser.add_argument("--objects", type=int, default=1000,
+                        help="number of synthetic networks to generate")
+    parser.add_argument("--iterations", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--port", type=int, default=54329)
+    parser.add_argument("--output", "-o", default="-")
+    parser.add_argument("--keep", action="store_true",
+                        help="keep the temporary cluster directory")
+    args = parser.parse_args()
+
+    with temporary_cluster(args.port, keep=args.keep) as dsn:
+        dsn = create_database(dsn, "bench")
+        results = run(dsn, args.objects, args.iterations, args.seed)
+
+    report = {"revision": git_revision(), "objects": args.objects,
+              "iterations": args.iterations, "seed": args.seed,
+              "results": results}
+    if args.output == "-":
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, "w") as fh:
+            json.dump(report, fh, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+# coding: utf-8
+
+import aiopg
+
+import lglass.database
+import lglass.nic
+import lglass.object
+
+import lglass_sql.base
+import lglass_sql.nic
+
+
+class AsyncDatabase(lglass.database.Database):
+    session_class = lglass_sql.base.Session
+    pool = None
+
+    def __init__(self, dsn, minsize=1, maxsize=10, schema=None,
+                 connect_options={}, storage="normalized"):
+        if storage not in lglass_sql.base.STORAGE_LAYOUTS:
+            raise ValueError("{!r} is not a valid storage layout, must be "
+                             "one of 'normalized' or 'compact'".format(
+                                 storage))
+        self.dsn = dsn
+        self.minsize = minsize
+        self.maxsize = maxsize
+        self._schema = schema
+        self._connect_options = connect_options
+        self.storage = storage
+        self.object_columns = self.session_class.object_columns
+        if storage == "compact":
+            self.object_columns = self.session_class.compact_object_columns
+
+    async def open(self):
+        if self.pool is None:
+            self.pool = await aiopg.create_pool(
+                self.dsn, minsize=self.minsize, maxsize=self.maxsize,
+                on_connect=self._configure, **self._connect_options)
+        return self
+
+    async def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            await self.pool.wait_closed()
+            self.pool = None
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def _configure(self, conn):
+        if self._schema is not None:
+            async with conn.cursor() as cur:
+                await cur.execute("SET search_path TO %s", (self._schema,))
+
+    async def _execute(self, cur, name, params=()):
+        await cur.execute(
+            lglass_sql.base._pyformat(self.session_class.statements[name]),
+            {str(n): v for n, v in enumerate(params, 1)})
+
+    async def _fetchall(self, query, params=None):
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(query, params)
+                return await cur.fetchall()
+
+    def _object_from_row(self, row):
+        obj = lglass.object.Object(row[6])
+        obj.sql_id = row[0]
+        return obj
+
+    def primary_spec(self, obj):
+        class_, key = super().primary_spec(obj)
+        return class_, key.lower()
+
+    async def fetch(self, class_, key):
+        rows = await self._fetchall(
+            "SELECT " + self.object_columns + " FROM object "
+            "WHERE lower(class) = lower(%s) AND lower(key) = lower(%s)",
+            (class_, key))
+        if not rows:
+            raise KeyError(repr((class_, key)))
+        return self._object_from_row(rows[0])
+
+    async def fetch_id(self, class_, key):
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await self._execute(cur, "lglass_fetch_id", (class_, key))
+                row = await cur.fetchone()
+        return row[0] if row is not None else None
+
+    async def fetch_many(self, specs):
+        specs = [(class_.lower(), key.lower()) for class_, key in specs]
+        if not specs:
+            return []
+        rows = await self._fetchall(
+            "SELECT " + self.object_columns + " FROM object "
+            "WHERE (lower(class), lower(key)) IN %s", (tuple(specs),))
+        objs = {(row[1].lower(), row[2].lower()): row for row in rows}
+        return [self._object_from_row(objs[spec]) for spec in specs
+                if spec in objs]
+
+    async def find(self, filter=None, classes=None, keys=None):
+        if not classes:
+            classes = self.object_classes
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(*lglass_sql.base.find_query(
+                    self.object_columns, classes, keys))
+                async for row in cur:
+                    if callable(keys) and not keys(row[2]):
+                        continue
+                    obj = self._object_from_row(row)
+                    if callable(filter) and not filter(obj):
+                        continue
+                    yield obj
+
+
+class AsyncNicDatabase(AsyncDatabase, lglass.nic.NicDatabaseMixin):
+    session_class = lglass_sql.nic.NicSession
+
+    def __init__(self, dsn, *args, **kwargs):
+        AsyncDatabase.__init__(self, dsn, *args, **kwargs)
+        lglass.nic.NicDatabaseMixin.__init__(self)
+
+    def _object_from_row(self, row):
+        return lglass_sql.nic.object_from_row(self.create_object, row)
+
+    async def _lookup(self, name, params):
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await self._execute(cur, name, params)
+                return await cur.fetchall()
+
+    async def lookup_route(self, address, limit=None):
+        return await self._lookup("lglass_lookup_route",
+                                  (str(address), limit))
+
+    async def lookup_inetnum(self, address, relation='>>=', limit=None,
+                             order='DESC'):
+        lglass_sql.nic._check_inetnum_args(relation, order)
+        return await self._lookup(
+            lglass_sql.nic._inetnum_statement_name(relation, order),
+            (str(address), limit))
+
+    async def lookup_as_block(self, asn):
+        return await self._lookup("lglass_lookup_as_block", (asn,))
+
+    async def lookup_domain(self, domain):
+        return await self._lookup("lglass_lookup_domain",
+                                  (domain[::-1] + '%',))
+
+    async def search_inverse(self, inverse_keys, inverse_values,
+                             classes=None, keys=None, objects=True):
+        if classes is None:
+            classes = self.object_classes
+        if objects:
+            columns = self.object_columns
+        else:
+            columns = "object.class, object.key"
+        rows = await self._fetchall(*lglass_sql.nic.search_inverse_query(
+            columns, inverse_keys, inverse_values, classes))
+        if objects:
+            return [self._object_from_row(row) for row in rows]
+        return rows
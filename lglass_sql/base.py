@@ -1,5 +1,14 @@
 # coding: utf-8
 
+import base64
+import io
+import itertools
+import json
+import re
+import threading
+import time
+import weakref
+
 import psycopg2 as pg
 import psycopg2.extras
 import psycopg2.extensions
@@ -7,22 +16,270 @@ import psycopg2.pool
 
 import lglass.database
 
+import lglass_sql.instrument
+import lglass_sql.pool
+import lglass_sql.writer
+
+
+def _copy_value(value):
+    if value is None:
+        return "\\N"
+    return str(value).replace("\\", "\\\\").replace("\t", "\\t") \
+        .replace("\n", "\\n").replace("\r", "\\r")
+
+
+def copy_rows(cur, table, columns, rows):
+    buf = io.StringIO()
+    for row in rows:
+        buf.write("\t".join(map(_copy_value, row)))
+        buf.write("\n")
+    buf.seek(0)
+    cur.copy_expert("COPY {} ({}) FROM STDIN".format(
+        table, ", ".join(columns)), buf)
+
+
+def _search_values(value):
+    if isinstance(value, str):
+        return (value,)
+    elif isinstance(value, (list, tuple, set, frozenset)) \
+            and value and all(isinstance(v, str) for v in value):
+        return tuple(value)
+
+
+def _match_query(obj, query):
+    for key, pred in query.items():
+        values = [v for k, v in obj.data if k == key]
+        if callable(pred):
+            if not any(map(pred, values)):
+                return False
+        elif pred not in values:
+            return False
+    return True
+
+
+def encode_token(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def decode_token(token):
+    try:
+        return json.loads(base64.urlsafe_b64decode(token.encode()).decode())
+    except (ValueError, UnicodeError):
+        raise ValueError("{!r} is not a valid continuation token".format(
+            token))
+
+
+def find_query(columns, classes, keys=None):
+    query = "SELECT " + columns + " FROM object " \
+            "WHERE lower(class) IN %(classes)s "
+    query_keys = tuple()
+    if keys and not callable(keys):
+        query += "AND lower(key) IN %(keys)s"
+        query_keys = tuple(map(str.lower, keys))
+    return query, {"classes": tuple(classes), "keys": query_keys}
+
+
+def projected_columns(cur, fields, storage="normalized"):
+    # The lines of the class attribute are always part of the projection
+    condition = "false"
+    if fields:
+        condition = "{{key}} IN {}".format(cur.mogrify(
+            "%s", (tuple(fields),)).decode().replace("%", "%%"))
+    if storage == "compact":
+        return ("object.id, object.class, object.key, object.last_modified, "
+                "object.created, object.source, "
+                "ARRAY(SELECT ARRAY[object.fields[i][1], "
+                "object.fields[i][2]] "
+                "FROM generate_subscripts(object.fields, 1) AS i "
+                "WHERE lower(object.fields[i][1]) = lower(object.class) "
+                "OR {} ORDER BY i)".format(
+                    condition.format(key="object.fields[i][1]")))
+    return ("object.id, object.class, object.key, object.last_modified, "
+            "object.created, object.source, "
+            "ARRAY(SELECT ARRAY[f.key, f.value] FROM object_field AS f "
+            "WHERE f.object_id = object.id "
+            "AND (lower(f.key) = lower(object.class) OR {}) "
+            "ORDER BY f.position)".format(condition.format(key="f.key")))
+
+
+STORAGE_LAYOUTS = {"normalized", "compact"}
+
+_cursor_ids = itertools.count()
+
+_prepared = weakref.WeakKeyDictionary()
+
+_placeholder = re.compile(r"\$(\d+)")
+
+
+def _pyformat(query):
+    return _placeholder.sub(r"%(\1)s", query)
+
+
+def _is_pool(dsn_or_pool):
+    return isinstance(dsn_or_pool, (pg.pool.AbstractConnectionPool,
+                                    lglass_sql.pool.ConnectionPool))
+
+
+class Replica(object):
+    pool = None
+    dsn = None
+
+    def __init__(self, dsn_or_pool, create_pool=None):
+        if _is_pool(dsn_or_pool):
+            self.pool = dsn_or_pool
+        else:
+            self.dsn = dsn_or_pool
+        self.failed_until = None
+        self._create_pool = create_pool
+        self._lock = threading.Lock()
+
+    def get_pool(self):
+        # Implicit pools are created on first use, so that a replica that
+        # is down does not keep the database from starting
+        if self.pool is None and self._create_pool is not None:
+            with self._lock:
+                if self.pool is None:
+                    self.pool = self._create_pool(self.dsn)
+        return self.pool
+
+    @property
+    def available(self):
+        return self.failed_until is None \
+            or self.failed_until <= time.monotonic()
+
+    def fail(self, retry):
+        self.failed_until = time.monotonic() + retry
+
+    def __repr__(self):
+        return "<Replica {!r}>".format(self.dsn or self.pool)
+
+
+class LazyObject(object):
+    def __init__(self, partial, fields, loader, key=None):
+        self.sql_id = getattr(partial, "sql_id", None)
+        self._partial = partial
+        # Keys outside the projection that the partial object carries were
+        # restored from the object row and are complete as well
+        self._fields = frozenset(fields) | {k for k, _ in partial.data}
+        self._key = key
+        self._loader = loader
+        self._full = None
+
+    @property
+    def loaded(self):
+        return self._full is not None
+
+    def _object(self, key=None):
+        if isinstance(key, str) and key in self._fields:
+            return self._partial
+        if self._full is None:
+            self._full = self._loader()
+            self._full.sql_id = self.sql_id
+        return self._full
+
+    @property
+    def object_class(self):
+        return self._partial.object_class
+
+    @property
+    def primary_key(self):
+        if self._full is None and self._key is not None:
+            try:
+                primary_key = self._partial.primary_key
+            except (KeyError, IndexError, ValueError, AttributeError):
+                primary_key = None
+            # Only trust the partial object if it yields the stored key
+            if primary_key is not None and \
+                    str(primary_key).lower() == self._key.lower():
+                return primary_key
+        return self._object().primary_key
+
+    def get(self, key, *args, **kwargs):
+        return self._object(key).get(key, *args, **kwargs)
+
+    def getfirst(self, key, *args, **kwargs):
+        return self._object(key).getfirst(key, *args, **kwargs)
+
+    def __getitem__(self, key):
+        return self._object(key)[key]
+
+    def __contains__(self, key):
+        return key in self._object(key)
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        # Accessors such as origin or last_modified read the attribute of
+        # the same name, which the partial object has if it was projected
+        return getattr(self._object(name.replace("_", "-")), name)
+
+    def __iter__(self):
+        return iter(self._object())
+
+    def __len__(self):
+        return len(self._object())
+
+    def __eq__(self, other):
+        if isinstance(other, LazyObject):
+            other = other._object()
+        return self._object() == other
+
+    def __hash__(self):
+        return hash(self._object())
+
+    def __str__(self):
+        return str(self._object())
+
+    def __repr__(self):
+        return "<LazyObject {!r} {}>".format(
+            self.sql_id, "loaded" if self.loaded else "partial")
+
 
 class Database(lglass.database.Database):
     pool = None
     dsn = None
 
     def __init__(self, dsn_or_pool, connect_options={}, implicit_pool=False,
-            schema=None):
-        if isinstance(dsn_or_pool, pg.pool.AbstractConnectionPool):
+            schema=None, streaming=False, itersize=2000, cache=None,
+            pool_minconn=1, pool_maxconn=10, pool_timeout=None,
+            prepare=False, query_hooks=None, storage="normalized",
+            replicas=(), replica_retry=30.0, read_your_writes=None):
+        if storage not in STORAGE_LAYOUTS:
+            raise ValueError("{!r} is not a valid storage layout, must be "
+                             "one of 'normalized' or 'compact'".format(
+                                 storage))
+        self._connect_options = connect_options
+        self._schema = schema
+        if _is_pool(dsn_or_pool):
             self.pool = dsn_or_pool
         elif implicit_pool:
-            self.pool = pg.pool.SimpleConnectionPool(1, 2, dsn_or_pool,
-                    **connect_options)
+            self.dsn = dsn_or_pool
+            self.pool = self._create_pool(dsn_or_pool, pool_minconn,
+                                          pool_maxconn, pool_timeout)
         else:
             self.dsn = dsn_or_pool
-        self._connect_options = connect_options
-        self._schema = schema
+        create_pool = None
+        if implicit_pool:
+            def create_pool(dsn):
+                return self._create_pool(dsn, pool_minconn, pool_maxconn,
+                                         pool_timeout)
+        self.replicas = [Replica(replica, create_pool)
+                         for replica in replicas]
+        self.replica_retry = replica_retry
+        self.read_your_writes = read_your_writes
+        self._replica_cycle = itertools.count()
+        self._last_writes = {}
+        self.streaming = streaming
+        self.itersize = itersize
+        self.cache = cache
+        self.prepare = prepare
+        self.query_hooks = list(query_hooks or [])
+        self.storage = storage
+
+    def _create_pool(self, dsn, minconn, maxconn, timeout):
+        return lglass_sql.pool.ConnectionPool(
+            minconn, maxconn, dsn, connect_options=self._connect_options,
+            configure=self._configure, timeout=timeout)
 
     def save(self, obj, **options):
         with self.session() as sess:
@@ -35,44 +292,174 @@ class Database(lglass.database.Database):
             sess.delete(obj)
             sess.commit()
 
-    def fetch(self, class_, key):
-        with self.session() as sess:
-            return sess.fetch(class_, key)
+    def writer(self, **options):
+        return lglass_sql.writer.WriteBehindQueue(self, **options)
+
+    def fetch(self, class_, key, fields=None, lazy=False):
+        generation = None
+        if self.cache is not None:
+            obj = self.cache.get(class_, key)
+            if obj is not None:
+                return obj
+            generation = self.cache.generation()
+        obj, primary = self._read(lambda sess: (
+            sess.fetch(class_, key, fields=fields, lazy=lazy),
+            sess.replica is None))
+        # Replicas may lag behind the evictions sent by the primary, so only
+        # primary reads populate the cache
+        if self.cache is not None and fields is None and primary:
+            self.cache.put(class_, key, obj, generation=generation)
+        return obj
 
     def fetch_by_id(self, id_):
-        with self.session() as sess:
-            return sess.fetch_by_id(id_)
+        generation = None
+        if self.cache is not None:
+            obj = self.cache.get_by_id(id_)
+            if obj is not None:
+                return obj
+            generation = self.cache.generation()
+        obj, primary = self._read(lambda sess: (sess.fetch_by_id(id_),
+                                                sess.replica is None))
+        if self.cache is not None and primary:
+            self.cache.put(*self.primary_spec(obj), obj, id_=id_,
+                           generation=generation)
+        return obj
 
     def fetch_id(self, class_, key):
-        with self.session() as sess:
-            return sess.fetch_id(class_, key)
+        return self._read(lambda sess: sess.fetch_id(class_, key))
+
+    def fetch_many(self, specs, fields=None, lazy=False):
+        return self._read(lambda sess: list(
+            sess.fetch_many(specs, fields=fields, lazy=lazy)))
+
+    def fetch_many_by_id(self, ids, fields=None, lazy=False):
+        return self._read(lambda sess: list(
+            sess.fetch_many_by_id(ids, fields=fields, lazy=lazy)))
 
     def lookup(self, classes=None, keys=None):
-        with self.session() as sess:
-            return list(sess.lookup(classes=classes, keys=keys))
+        return self._iterate("lookup", classes=classes, keys=keys)
 
-    def search(self, query={}, classes=None, keys=None):
-        with self.session() as sess:
-            return list(sess.search(query={}, classes=None, keys=None))
+    def lookup_ids(self, classes=None, keys=None):
+        return self._iterate("lookup_ids", classes=classes, keys=keys)
 
-    def find(self, filter=None, classes=None, keys=None):
-        with self.session() as sess:
-            return list(sess.find(filter=filter, classes=classes, keys=keys))
+    def all_ids(self):
+        return self._iterate("all_ids")
 
-    def _connect(self):
-        if self.pool is not None:
-            conn = self.pool.getconn()
+    def lookup_page(self, *args, **kwargs):
+        return self._read(lambda sess: sess.lookup_page(*args, **kwargs))
+
+    def find_page(self, *args, **kwargs):
+        return self._read(lambda sess: sess.find_page(*args, **kwargs))
+
+    def search(self, query={}, classes=None, keys=None):
+        return self._iterate("search", query=query, classes=classes,
+                             keys=keys)
+
+    def find(self, filter=None, classes=None, keys=None, fields=None,
+             lazy=False):
+        return self._iterate("find", filter=filter, classes=classes,
+                             keys=keys, fields=fields, lazy=lazy)
+
+    def _iterate(self, method, *args, **kwargs):
+        if self.streaming:
+            return self._stream(method, *args, **kwargs)
+        return self._read(
+            lambda sess: list(getattr(sess, method)(*args, **kwargs)))
+
+    def _stream(self, method, *args, **kwargs):
+        with self.session(streaming=True, readonly=True) as sess:
+            yield from getattr(sess, method)(*args, **kwargs)
+
+    def _read(self, func):
+        while True:
+            with self.session(readonly=True) as sess:
+                try:
+                    return func(sess)
+                except (pg.OperationalError, pg.InterfaceError):
+                    # Only a lost replica connection is retried elsewhere,
+                    # query errors are reported as usual. This is checked
+                    # before the session closes or returns the connection.
+                    if sess.replica is None or not sess.conn.closed:
+                        raise
+            sess.replica.fail(self.replica_retry)
+
+    def _wrote(self, thread=None):
+        # Writes are tracked per thread, the write-behind queue records its
+        # writes for the threads that queued them
+        if self.read_your_writes is None:
+            return
+        now = time.monotonic()
+        if len(self._last_writes) > 1024:
+            for ident, last_write in list(self._last_writes.items()):
+                if now - last_write >= self.read_your_writes:
+                    self._last_writes.pop(ident, None)
+        if thread is None:
+            thread = threading.get_ident()
+        self._last_writes[thread] = now
+
+    def _read_replicas(self):
+        if not self.replicas:
+            return []
+        if self.read_your_writes is not None:
+            last_write = self._last_writes.get(threading.get_ident())
+            if last_write is not None and \
+                    time.monotonic() - last_write < self.read_your_writes:
+                return []
+        start = next(self._replica_cycle) % len(self.replicas)
+        replicas = self.replicas[start:] + self.replicas[:start]
+        return [replica for replica in replicas if replica.available]
+
+    def _connect(self, replica=None):
+        pool, dsn = self.pool, self.dsn
+        if replica is not None:
+            pool, dsn = replica.get_pool(), replica.dsn
+        if pool is not None and \
+                getattr(pool, "_configure", None) == self._configure:
+            # Pools built by _create_pool configure their connections
+            return pool.getconn()
+        elif pool is not None:
+            conn = pool.getconn()
         else:
-            conn = pg.connect(self.dsn, **self._connect_options)
+            conn = pg.connect(dsn, **self._connect_options)
+        self._configure(conn)
+        return conn
+
+    def _checkout(self, readonly=False):
+        start = time.perf_counter()
+        if readonly:
+            for replica in self._read_replicas():
+                try:
+                    conn = self._connect(replica)
+                except pg.pool.PoolError:
+                    continue
+                except pg.OperationalError:
+                    replica.fail(self.replica_retry)
+                    continue
+                return (conn, replica, replica.pool,
+                        time.perf_counter() - start)
+        return self._connect(), None, self.pool, time.perf_counter() - start
+
+    def _configure(self, conn):
         if self._schema is not None:
             with conn.cursor() as cur:
                 cur.execute("SET search_path TO %s", (self._schema,))
-        return conn
 
-    def session(self, conn=None):
+    def close(self):
+        if self.pool is not None:
+            self.pool.closeall()
+        for replica in self.replicas:
+            if replica.pool is not None:
+                replica.pool.closeall()
+
+    def session(self, conn=None, streaming=False, readonly=False):
         if conn is not None:
-            return Session(self, conn)
-        return Session(self, self._connect(), pool=self.pool)
+            return Session(self, conn, streaming=streaming)
+        conn, replica, pool, wait = self._checkout(readonly)
+        return Session(self, conn, pool=pool, streaming=streaming, wait=wait,
+                       replica=replica)
+
+    def add_query_hook(self, hook):
+        self.query_hooks.append(hook)
 
     def primary_spec(self, obj):
         class_, key = super().primary_spec(obj)
@@ -80,14 +467,96 @@ class Database(lglass.database.Database):
 
 
 class Session(lglass.database.ProxyDatabase):
-    def __init__(self, backend, conn, pool=None):
+    object_columns = (
+        "object.id, object.class, object.key, object.last_modified, "
+        "object.created, object.source, "
+        "ARRAY(SELECT ARRAY[f.key, f.value] FROM object_field AS f "
+        "WHERE f.object_id = object.id ORDER BY f.position)")
+    compact_object_columns = (
+        "object.id, object.class, object.key, object.last_modified, "
+        "object.created, object.source, object.fields")
+
+    statements = {
+        "lglass_fetch":
+            "SELECT object.id, object_field.key, object_field.value "
+            "FROM object_field, object "
+            "WHERE object.id = object_field.object_id "
+            "AND lower(object.class) = lower($1) "
+            "AND lower(object.key) = lower($2) "
+            "ORDER BY object_field.position",
+        "lglass_fetch_id":
+            "SELECT id FROM object "
+            "WHERE lower(class) = lower($1) AND lower(key) = lower($2)",
+        "lglass_fetch_compact":
+            "SELECT " + compact_object_columns + " FROM object "
+            "WHERE lower(class) = lower($1) AND lower(key) = lower($2)"
+    }
+
+    def __init__(self, backend, conn, pool=None, streaming=False, wait=None,
+                 replica=None):
         super().__init__(backend)
         self.conn = conn
         self.pool = pool
+        self.replica = replica
+        self.streaming = streaming
+        self.wait = wait
+        self.query_hooks = getattr(backend, "query_hooks", [])
+        self.storage = getattr(backend, "storage", "normalized")
+        if self.storage == "compact":
+            self.object_columns = self.compact_object_columns
+        self.itersize = getattr(backend, "itersize", 2000)
+        self.prepare = getattr(backend, "prepare", False)
+        self._written_specs = set()
+        self._written_ids = set()
+
+    def _execute(self, cur, name, params=()):
+        if not self.prepare:
+            cur.execute(_pyformat(self.statements[name]),
+                        {str(n): v for n, v in enumerate(params, 1)})
+            return
+        prepared = _prepared.setdefault(self.conn, set())
+        if name not in prepared:
+            cur.execute("PREPARE {} AS {}".format(
+                name, self.statements[name]))
+            prepared.add(name)
+        if params:
+            cur.execute("EXECUTE {} ({})".format(
+                name, ", ".join(["%s"] * len(params))), params)
+        else:
+            cur.execute("EXECUTE {}".format(name))
+
+    def _cursor(self, label, name=None):
+        if not self.query_hooks:
+            return self.conn.cursor(name=name)
+        cur = self.conn.cursor(
+            name=name,
+            cursor_factory=lglass_sql.instrument.InstrumentedCursor)
+        cur.label = label
+        cur.hooks = self.query_hooks
+        cur.wait, self.wait = self.wait, None
+        return cur
+
+    def _stream_cursor(self, label):
+        if not self.streaming:
+            return self._cursor(label)
+        cur = self._cursor(label,
+                           name="lglass_sql_{}".format(next(_cursor_ids)))
+        cur.itersize = self.itersize
+        return cur
 
     def save(self, obj, **options):
         primary_class, primary_key = self.primary_spec(obj)
-        with self.conn.cursor() as cur:
+        self._written((primary_class, primary_key))
+        with self._cursor("save") as cur:
+            if self.storage == "compact":
+                cur.execute(
+                    "INSERT INTO object (class, key, fields) "
+                    "VALUES (lower(%s), lower(%s), %s) "
+                    "ON CONFLICT (lower(class), lower(key)) DO UPDATE "
+                    "SET fields = EXCLUDED.fields RETURNING id",
+                    (primary_class, primary_key,
+                     [list(line) for line in obj.data]))
+                return cur.fetchone()[0]
             cur.execute(
                 "INSERT INTO object (class, key) "
                 "VALUES (lower(%s), lower(%s)) "
@@ -106,23 +575,54 @@ class Session(lglass.database.ProxyDatabase):
 
     def delete(self, obj):
         primary_class, primary_key = self.primary_spec(obj)
-        with self.conn.cursor() as cur:
+        with self._cursor("delete") as cur:
             cur.execute(
                 "DELETE FROM object WHERE lower(class) = lower(%s) "
                 "AND lower(key) = lower(%s)",
                 (primary_class, primary_key))
             if not cur.rowcount:
                 raise KeyError(repr((primary_class, primary_key)))
-
-    def fetch(self, class_, key):
-        with self.conn.cursor() as cur:
+        self._written((primary_class, primary_key))
+
+    def _fetch_compact(self, class_, key):
+        with self._cursor("fetch") as cur:
+            self._execute(cur, "lglass_fetch_compact", (class_, key))
+            row = cur.fetchone()
+        if row is None:
+            raise KeyError(repr((class_, key)))
+        return self._object_from_row(row)
+
+    def _columns(self, cur, fields):
+        if fields is None:
+            return self.object_columns
+        return projected_columns(cur, fields, self.storage)
+
+    def _projected_object(self, row, fields, lazy):
+        obj = self._object_from_row(row)
+        if lazy and fields is not None:
+            return LazyObject(obj, fields,
+                              lambda: self.backend.fetch_by_id(row[0]),
+                              key=row[2])
+        return obj
+
+    def _fetch_projected(self, class_, key, fields, lazy):
+        with self._cursor("fetch") as cur:
             cur.execute(
-                "SELECT object.id, object_field.key, object_field.value "
-                "FROM object_field, object "
-                "WHERE object.id = object_field.object_id "
-                "AND lower(object.class) = lower(%s) "
-                "AND lower(object.key) = lower(%s) "
-                "ORDER BY object_field.position", (class_, key))
+                "SELECT " + self._columns(cur, fields) + " FROM object "
+                "WHERE lower(class) = lower(%s) AND lower(key) = lower(%s)",
+                (class_, key))
+            row = cur.fetchone()
+        if row is None:
+            raise KeyError(repr((class_, key)))
+        return self._projected_object(row, fields, lazy)
+
+    def fetch(self, class_, key, fields=None, lazy=False):
+        if fields is not None:
+            return self._fetch_projected(class_, key, fields, lazy)
+        if self.storage == "compact":
+            return self._fetch_compact(class_, key)
+        with self._cursor("fetch") as cur:
+            self._execute(cur, "lglass_fetch", (class_, key))
             if not cur.rowcount:
                 raise KeyError(repr((class_, key)))
             obj_id, fkey, fval = cur.fetchone()
@@ -132,41 +632,71 @@ class Session(lglass.database.ProxyDatabase):
             return obj
 
     def fetch_by_id(self, object_id):
-        with self.conn.cursor() as cur:
-            cur.execute("SELECT key, value FROM object_field "
-                        "WHERE object_id = %s "
-                        "ORDER BY position", (object_id,))
-            if not cur.rowcount:
-                raise KeyError(repr((class_, key)))
-            return lglass.object.Object(cur.fetchall())
+        with self._cursor("fetch_by_id") as cur:
+            cur.execute("SELECT " + self.object_columns + " FROM object "
+                        "WHERE id = %s", (object_id,))
+            row = cur.fetchone()
+        if row is None:
+            raise KeyError(object_id)
+        return self._object_from_row(row)
 
     def fetch_id(self, class_, key):
-        with self.conn.cursor() as cur:
-            cur.execute("SELECT id FROM object "
-                        "WHERE lower(class) = lower(%s) "
-                        "AND lower(key) = lower(%s)",
-                        (class_, key))
+        with self._cursor("fetch_id") as cur:
+            self._execute(cur, "lglass_fetch_id", (class_, key))
             if not cur.rowcount:
                 return None
             return cur.fetchone()[0]
 
+    def _object_from_row(self, row):
+        obj = lglass.object.Object(row[6])
+        obj.sql_id = row[0]
+        return obj
+
+    def fetch_many(self, specs, fields=None, lazy=False):
+        specs = [(class_.lower(), key.lower()) for class_, key in specs]
+        if not specs:
+            return
+        with self._cursor("fetch_many") as cur:
+            cur.execute(
+                "SELECT " + self._columns(cur, fields) + " FROM object "
+                "WHERE (lower(class), lower(key)) IN %s", (tuple(specs),))
+            objs = {(row[1].lower(), row[2].lower()): row for row in cur}
+        for spec in specs:
+            if spec in objs:
+                yield self._projected_object(objs[spec], fields, lazy)
+
+    def fetch_many_by_id(self, ids, fields=None, lazy=False):
+        ids = list(ids)
+        if not ids:
+            return
+        with self._cursor("fetch_many_by_id") as cur:
+            cur.execute(
+                "SELECT " + self._columns(cur, fields) + " FROM object "
+                "WHERE id IN %s", (tuple(ids),))
+            objs = {row[0]: row for row in cur}
+        for id_ in ids:
+            if id_ in objs:
+                yield self._projected_object(objs[id_], fields, lazy)
+
     def delete_by_id(self, object_id):
-        with self.conn.cursor() as cur:
+        with self._cursor("delete_by_id") as cur:
             cur.execute("DELETE FROM object WHERE id = %s", (object_id,))
             if not cur.rowcount:
                 raise KeyError(object_id)
+        self._written(id_=object_id)
 
     def delete_by_spec(self, primary_class, primary_key):
-        with self.conn.cursor() as cur:
+        with self._cursor("delete_by_spec") as cur:
             cur.execute(
                 "DELETE FROM object "
                 "WHERE lower(class) = lower(%s) AND lower(key) = lower(%s)",
                 (primary_class, primary_key))
             if not cur.rowcount:
-                raise KeyError(object_id)
+                raise KeyError(repr((primary_class, primary_key)))
+        self._written((primary_class, primary_key))
 
     def all_ids(self):
-        with self.conn.cursor() as cur:
+        with self._stream_cursor("all_ids") as cur:
             cur.execute("SELECT id FROM object")
             yield from map(lambda t: t[0], cur)
 
@@ -176,20 +706,20 @@ class Session(lglass.database.ProxyDatabase):
         classes = tuple(classes)
 
         if keys is None:
-            with self.conn.cursor() as cur:
+            with self._stream_cursor("lookup") as cur:
                 cur.execute(
                     "SELECT id, class, key FROM object "
                     "WHERE lower(class) IN %s", (classes,))
                 yield from cur
         elif callable(keys):
-            with self.conn.cursor() as cur:
+            with self._stream_cursor("lookup") as cur:
                 cur.execute(
                     "SELECT id, class, key FROM object "
                     "WHERE lower(class) IN %s ", (classes,))
                 yield from filter(lambda x: keys(x[1]), cur)
         else:
             keys = tuple(map(str.lower, keys))
-            with self.conn.cursor() as cur:
+            with self._stream_cursor("lookup") as cur:
                 cur.execute(
                     "SELECT id, class, key FROM object "
                     "WHERE lower(class) IN %s "
@@ -204,15 +734,119 @@ class Session(lglass.database.ProxyDatabase):
         for id_, _, _ in self._lookup(classes=classes, keys=keys):
             yield id_
 
-    def search(self, query={}, classes=None, keys=None):
-        return lglass.database.Database.search(
-            self,
-            query=query, classes=classes, keys=keys)
+    def _page(self, rows, limit, token_values):
+        rows = list(rows)
+        token = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            token = encode_token(token_values(rows[-1]))
+        return rows, token
+
+    def lookup_page(self, classes=None, keys=None, after=None, limit=100):
+        if not classes:
+            classes = self.object_classes
+        query = "SELECT id, class, key FROM object " \
+                "WHERE lower(class) IN %(classes)s AND id > %(after)s "
+        query_keys = tuple()
+        if keys and not callable(keys):
+            query += "AND lower(key) IN %(keys)s "
+            query_keys = tuple(map(str.lower, keys))
+        query += "ORDER BY id LIMIT %(limit)s"
+        with self._cursor("lookup_page") as cur:
+            cur.execute(query, {
+                "classes": tuple(map(str.lower, classes)),
+                "keys": query_keys, "limit": limit + 1,
+                "after": decode_token(after)[0] if after else 0})
+            rows, token = self._page(cur, limit, lambda r: [r[0]])
+        return [(class_, key) for _, class_, key in rows
+                if not callable(keys) or keys(key)], token
+
+    def find_page(self, filter=None, classes=None, keys=None, after=None,
+                  limit=100):
+        if not classes:
+            classes = self.object_classes
+        query, params = find_query(self.object_columns, classes, keys)
+        query += " AND object.id > %(after)s ORDER BY object.id " \
+                 "LIMIT %(limit)s"
+        params.update(after=decode_token(after)[0] if after else 0,
+                      limit=limit + 1)
+        with self._cursor("find_page") as cur:
+            cur.execute(query, params)
+            rows, token = self._page(cur, limit, lambda r: [r[0]])
+        objs = []
+        for row in rows:
+            if callable(keys) and not keys(row[2]):
+                continue
+            obj = self._object_from_row(row)
+            if callable(filter) and not filter(obj):
+                continue
+            objs.append(obj)
+        return objs, token
 
-    def find(self, filter=None, classes=None, keys=None):
-        return lglass.database.Database.find(
-            self,
-            filter=filter, classes=classes, keys=keys)
+    def search(self, query={}, classes=None, keys=None):
+        if not classes:
+            classes = self.object_classes
+        conditions = ["lower(object.class) IN %s"]
+        params = [tuple(map(str.lower, classes))]
+        if keys and not callable(keys):
+            conditions.append("lower(object.key) IN %s")
+            params.append(tuple(map(str.lower, keys)))
+        residual = {}
+        for qkey, qvalue in query.items():
+            values = _search_values(qvalue)
+            if values is None:
+                residual[qkey] = qvalue
+                continue
+            condition, condition_params = self._search_condition(
+                qkey, values, classes)
+            conditions.append(condition)
+            params.extend(condition_params)
+        with self._stream_cursor("search") as cur:
+            cur.execute(
+                "SELECT " + self.object_columns + " FROM object "
+                "WHERE " + " AND ".join(conditions), params)
+            for row in cur:
+                if callable(keys) and not keys(row[2]):
+                    continue
+                obj = self._object_from_row(row)
+                if residual and not _match_query(obj, residual):
+                    continue
+                yield obj
+
+    def _search_condition(self, key, values, classes):
+        return self._field_condition(key, values)
+
+    def _field_condition(self, key, values, fold=False):
+        # With fold, values are compared ignoring case and spaces and must
+        # be given folded already
+        if self.storage == "compact":
+            value = "object.fields[i][2]"
+        else:
+            value = "f.value"
+        if fold:
+            value = "lower(replace({}, ' ', ''))".format(value)
+        if self.storage == "compact":
+            return ("EXISTS (SELECT 1 FROM generate_subscripts("
+                    "object.fields, 1) AS i WHERE object.fields[i][1] = %s "
+                    "AND " + value + " IN %s)", (key, values))
+        return ("EXISTS (SELECT 1 FROM object_field AS f "
+                "WHERE f.object_id = object.id AND f.key = %s "
+                "AND " + value + " IN %s)", (key, values))
+
+    def find(self, filter=None, classes=None, keys=None, fields=None,
+             lazy=False):
+        if not classes:
+            classes = self.object_classes
+        with self._stream_cursor("find") as cur:
+            cur.execute(*find_query(self._columns(cur, fields), classes,
+                                    keys))
+            for row in cur:
+                if callable(keys) and not keys(row[2]):
+                    continue
+                obj = self._projected_object(row, fields, lazy)
+                if callable(filter) and not filter(obj):
+                    continue
+                yield obj
 
     def close(self):
         if self.pool is not None:
@@ -220,8 +854,26 @@ class Session(lglass.database.ProxyDatabase):
         else:
             self.conn.close()
 
+    def _written(self, spec=None, id_=None):
+        if spec is not None:
+            self._written_specs.add((spec[0].lower(), spec[1].lower()))
+        if id_ is not None:
+            self._written_ids.add(id_)
+
     def commit(self):
         self.conn.commit()
+        if self._written_specs or self._written_ids:
+            wrote = getattr(self.backend, "_wrote", None)
+            if wrote is not None:
+                wrote()
+        cache = getattr(self.backend, "cache", None)
+        if cache is not None:
+            for spec in self._written_specs:
+                cache.evict(*spec)
+            for id_ in self._written_ids:
+                cache.evict_id(id_)
+        self._written_specs.clear()
+        self._written_ids.clear()
 
     def __enter__(self):
         return self
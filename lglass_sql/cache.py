@@ -0,0 +1,218 @@
+# coding: utf-8
+
+import collections
+import copy
+import json
+import select
+import threading
+import time
+
+import psycopg2 as pg
+import psycopg2.extensions
+
+NOTIFY_CHANNEL = "lglass_object"
+
+NOTIFY_TRIGGERS = """
+CREATE OR REPLACE FUNCTION lglass_notify_object() RETURNS trigger AS $$
+DECLARE
+    rec record;
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        rec := OLD;
+    ELSE
+        rec := NEW;
+    END IF;
+    IF TG_TABLE_NAME = 'object' THEN
+        PERFORM pg_notify('lglass_object', json_build_object(
+            'id', rec.id, 'class', rec.class, 'key', rec.key)::text);
+    ELSE
+        PERFORM pg_notify('lglass_object', json_build_object(
+            'id', rec.object_id)::text);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS object_notify ON object;
+CREATE TRIGGER object_notify AFTER INSERT OR UPDATE OR DELETE ON object
+    FOR EACH ROW EXECUTE PROCEDURE lglass_notify_object();
+
+DROP TRIGGER IF EXISTS object_field_notify ON object_field;
+CREATE TRIGGER object_field_notify
+    AFTER INSERT OR UPDATE OR DELETE ON object_field
+    FOR EACH ROW EXECUTE PROCEDURE lglass_notify_object();
+"""
+
+
+class ObjectCache(object):
+    def __init__(self, maxsize=10000, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = collections.OrderedDict()
+        self._ids = {}
+        self._version = 0
+        self._evicted = collections.OrderedDict()
+        self._floor = 0
+        self._lock = threading.Lock()
+
+    def get(self, class_, key):
+        spec = (class_.lower(), key.lower())
+        with self._lock:
+            entry = self._entries.get(spec)
+            if entry is not None and self.ttl is not None \
+                    and entry[0] < time.monotonic():
+                self._remove(spec)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(spec)
+            self.hits += 1
+            return copy.deepcopy(entry[2])
+
+    def get_by_id(self, id_):
+        with self._lock:
+            spec = self._ids.get(id_)
+        if spec is None:
+            self.misses += 1
+            return None
+        return self.get(*spec)
+
+    def generation(self):
+        with self._lock:
+            return self._version
+
+    def put(self, class_, key, obj, id_=None, generation=None):
+        spec = (class_.lower(), key.lower())
+        if id_ is None:
+            id_ = getattr(obj, "sql_id", None)
+        expires = None
+        if self.ttl is not None:
+            expires = time.monotonic() + self.ttl
+        obj = copy.deepcopy(obj)
+        with self._lock:
+            # Drop objects read before a concurrent eviction of their spec
+            if generation is not None and (
+                    generation < self._floor or
+                    self._evicted.get(spec, 0) > generation):
+                return
+            if spec in self._entries:
+                self._ids.pop(self._entries[spec][1], None)
+            self._entries[spec] = (expires, id_, obj)
+            self._entries.move_to_end(spec)
+            if id_ is not None:
+                self._ids[id_] = spec
+            while len(self._entries) > self.maxsize:
+                self._remove(next(iter(self._entries)))
+
+    def evict(self, class_, key):
+        with self._lock:
+            spec = (class_.lower(), key.lower())
+            self._remove(spec)
+            self._bump(spec)
+
+    def evict_id(self, id_):
+        with self._lock:
+            spec = self._ids.get(id_)
+            if spec is not None:
+                self._remove(spec)
+            self._bump(spec)
+
+    def clear(self):
+        with self._lock:
+            self.evictions += len(self._entries)
+            self._entries.clear()
+            self._ids.clear()
+            self._bump(None)
+
+    def _bump(self, spec):
+        self._version += 1
+        if spec is None:
+            # Unknown spec, invalidate every read that is in progress
+            self._floor = self._version
+            self._evicted.clear()
+            return
+        self._evicted[spec] = self._version
+        self._evicted.move_to_end(spec)
+        while len(self._evicted) > self.maxsize:
+            _, version = self._evicted.popitem(last=False)
+            self._floor = max(self._floor, version)
+
+    def _remove(self, spec):
+        entry = self._entries.pop(spec, None)
+        if entry is not None:
+            self._ids.pop(entry[1], None)
+            self.evictions += 1
+
+    @property
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions, "size": len(self._entries)}
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def install_triggers(database):
+    with database.session() as sess:
+        with sess.conn.cursor() as cur:
+            cur.execute(NOTIFY_TRIGGERS)
+        sess.commit()
+
+
+class CacheListener(threading.Thread):
+    def __init__(self, database, cache=None, channel=NOTIFY_CHANNEL,
+                 timeout=5.0, retry=5.0):
+        super().__init__(daemon=True)
+        if database.dsn is None:
+            raise ValueError("CacheListener requires a database with a DSN")
+        self.database = database
+        self.cache = cache if cache is not None else database.cache
+        self.channel = channel
+        self.timeout = timeout
+        self.retry = retry
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            try:
+                self._listen()
+            except (pg.OperationalError, pg.InterfaceError):
+                # Notifications may have been lost while disconnected
+                self.cache.clear()
+                self._stop_event.wait(self.retry)
+
+    def _listen(self):
+        conn = pg.connect(self.database.dsn,
+                          **self.database._connect_options)
+        try:
+            conn.set_isolation_level(
+                pg.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            with conn.cursor() as cur:
+                cur.execute("LISTEN {}".format(self.channel))
+            self.cache.clear()
+            while not self._stop_event.is_set():
+                if select.select([conn], [], [], self.timeout) == \
+                        ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    self._handle(conn.notifies.pop(0).payload)
+        finally:
+            conn.close()
+
+    def _handle(self, payload):
+        try:
+            change = json.loads(payload)
+        except ValueError:
+            return
+        if "id" in change:
+            self.cache.evict_id(change["id"])
+        if "class" in change and "key" in change:
+            self.cache.evict(change["class"], change["key"])
@@ -0,0 +1,67 @@
+# coding: utf-8
+
+import codecs
+import re
+
+_escape = re.compile(r"\\(?:([0-7]{1,3})|x([0-9a-fA-F]{1,2})|(.))")
+
+_escapes = {"b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t",
+            "v": "\v"}
+
+
+def _unescape_match(match):
+    if match.group(1):
+        return chr(int(match.group(1), 8))
+    elif match.group(2):
+        return chr(int(match.group(2), 16))
+    return _escapes.get(match.group(3), match.group(3))
+
+
+def unescape_copy(field):
+    if field == "\\N":
+        return None
+    if "\\" not in field:
+        return field
+    return _escape.sub(_unescape_match, field)
+
+
+def format_line(key, value, width=16):
+    lines = value.split("\n")
+    head = (key + ":").ljust(width) + lines[0]
+    rest = [" " * width + line if line else "+" for line in lines[1:]]
+    return "\n".join([head] + rest).rstrip(" ") + "\n"
+
+
+class RPSLWriter(object):
+    def __init__(self, fh, width=16):
+        self.fh = fh
+        self.width = width
+        self.objects = 0
+        self._buffer = ""
+        self._current = None
+        self._decoder = codecs.getincrementaldecoder("utf-8")()
+
+    def write(self, data):
+        if isinstance(data, bytes):
+            data = self._decoder.decode(data)
+        self._buffer += data
+        *lines, self._buffer = self._buffer.split("\n")
+        for line in lines:
+            self._write_row(line)
+        return len(data)
+
+    def _write_row(self, line):
+        id_, key, value = (unescape_copy(f) for f in line.split("\t"))
+        if id_ != self._current:
+            if self._current is not None:
+                self.fh.write("\n")
+            self._current = id_
+            self.objects += 1
+        self.fh.write(format_line(key, value or "", self.width))
+
+    def close(self):
+        if self._buffer:
+            self._write_row(self._buffer)
+            self._buffer = ""
+        if self._current is not None:
+            self.fh.write("\n")
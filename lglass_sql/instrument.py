@@ -0,0 +1,126 @@
+# coding: utf-8
+
+import bisect
+import collections
+import logging
+import threading
+import time
+
+import psycopg2 as pg
+import psycopg2.extensions
+
+logger = logging.getLogger(__name__)
+
+QueryEvent = collections.namedtuple(
+    "QueryEvent",
+    ["name", "query", "params", "duration", "rowcount", "wait", "connection"])
+
+
+class InstrumentedCursor(pg.extensions.cursor):
+    label = None
+    hooks = ()
+    wait = None
+
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            self._emit(query, vars, time.perf_counter() - start)
+
+    def copy_expert(self, sql, file, size=8192):
+        start = time.perf_counter()
+        try:
+            return super().copy_expert(sql, file, size)
+        finally:
+            self._emit(sql, None, time.perf_counter() - start)
+
+    def _emit(self, query, params, duration):
+        # The checkout wait is reported with the first statement only
+        wait, self.wait = self.wait, None
+        event = QueryEvent(self.label, query, params, duration,
+                           self.rowcount, wait, self.connection)
+        for hook in self.hooks:
+            try:
+                hook(event)
+            except Exception:
+                logger.exception("query hook %r failed", hook)
+
+
+class QueryStats(object):
+    buckets = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0,
+               2.0, 5.0)
+
+    def __init__(self):
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        with self._lock:
+            stats = self._stats.get(event.name)
+            if stats is None:
+                stats = self._stats[event.name] = {
+                    "count": 0, "total": 0.0, "max": 0.0, "rows": 0,
+                    "wait": 0.0,
+                    "histogram": [0] * (len(self.buckets) + 1)}
+            stats["count"] += 1
+            stats["total"] += event.duration
+            stats["max"] = max(stats["max"], event.duration)
+            if event.rowcount is not None and event.rowcount > 0:
+                stats["rows"] += event.rowcount
+            if event.wait is not None:
+                stats["wait"] += event.wait
+            stats["histogram"][bisect.bisect_left(self.buckets,
+                                                  event.duration)] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {name: dict(stats, histogram=list(stats["histogram"]),
+                               mean=stats["total"] / stats["count"])
+                    for name, stats in self._stats.items()}
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+
+class SlowQueryLog(object):
+    def __init__(self, threshold=0.1, maxlen=100, explain=True):
+        self.threshold = threshold
+        self.explain = explain
+        self.entries = collections.deque(maxlen=maxlen)
+
+    def __call__(self, event):
+        if event.duration < self.threshold:
+            return
+        plan = None
+        if self.explain and event.query.lstrip().upper().startswith(
+                ("SELECT", "EXECUTE")):
+            plan = self._explain(event)
+        self.entries.append({"name": event.name, "query": event.query,
+                             "params": event.params,
+                             "duration": event.duration, "plan": plan})
+
+    def _explain(self, event):
+        conn = event.connection
+        in_transaction = not conn.autocommit and \
+            conn.info.transaction_status == \
+            pg.extensions.TRANSACTION_STATUS_INTRANS
+        if conn.info.transaction_status not in {
+                pg.extensions.TRANSACTION_STATUS_IDLE,
+                pg.extensions.TRANSACTION_STATUS_INTRANS}:
+            return None
+        with conn.cursor() as cur:
+            if in_transaction:
+                cur.execute("SAVEPOINT lglass_explain")
+            try:
+                cur.execute("EXPLAIN (ANALYZE, BUFFERS) " + event.query,
+                            event.params)
+                return "\n".join(row[0] for row in cur)
+            except pg.Error:
+                return None
+            finally:
+                if in_transaction:
+                    cur.execute("ROLLBACK TO SAVEPOINT lglass_explain")
+                elif not conn.autocommit:
+                    conn.rollback()
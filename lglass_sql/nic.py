@@ -1,6 +1,13 @@
 # coding: utf-8
 
+import concurrent.futures
+import difflib
+import gzip
+import hashlib
 import itertools
+import logging
+import os
+import time
 
 import psycopg2 as pg
 import psycopg2.extras
@@ -10,33 +17,210 @@ import psycopg2.pool
 import lglass.nic
 
 import lglass_sql.base
+import lglass_sql.export
+import lglass_sql.prefix
+
+logger = logging.getLogger(__name__)
+
+
+INSERTED = "inserted"
+UPDATED = "updated"
+UNCHANGED = "unchanged"
+
+# Spacing of object_field positions written by NicSession.save, leaving room
+# for lines inserted later without renumbering the following ones
+POSITION_STEP = 1024
+
+# Journal source for changes to objects without a source attribute
+DEFAULT_SOURCE = "UNSOURCED"
+
+
+def object_digest(obj):
+    digest = hashlib.sha1()
+    for key, value in obj.data:
+        digest.update("{}:{}\n".format(key, value).encode())
+    digest.update(repr((obj.source, obj.created,
+                        obj.last_modified)).encode())
+    return digest.hexdigest()
 
 
 class NicDatabase(lglass_sql.base.Database, lglass.nic.NicDatabaseMixin):
-    def __init__(self, dsn_or_pool, *args, database_name=None, **kwargs):
+    def __init__(self, dsn_or_pool, *args, database_name=None,
+                 prefix_index=None, **kwargs):
         lglass_sql.base.Database.__init__(self, dsn_or_pool, *args, **kwargs)
         lglass.nic.NicDatabaseMixin.__init__(self)
         self._manifest = None
+        self._inverse_keys = {}
+        self.invalid_ids = []
+        self.invalid_specs = []
+        self.prefix_index = prefix_index
         if database_name is None:
             database_name = self._get_database_name()
         self._database_name = database_name
 
-    def session(self, conn=None):
+    def session(self, conn=None, streaming=False, readonly=False):
         if conn is not None:
-            return NicSession(self, conn)
-        return NicSession(self, self._connect(), pool=self.pool)
+            return NicSession(self, conn, streaming=streaming)
+        conn, replica, pool, wait = self._checkout(readonly)
+        return NicSession(self, conn, pool=pool, streaming=streaming,
+                          wait=wait, replica=replica)
 
-    def lookup_route(self, *args, **kwargs):
-        with self.session() as sess:
-            return list(sess.lookup_route(*args, **kwargs))
+    def lookup_route(self, *args, objects=False, **kwargs):
+        if self.prefix_index is not None:
+            return self._lookup_index("lookup_route", args, kwargs, objects)
+        return self._lookup_aux("lookup_route", args, kwargs, objects)
+
+    def lookup_inetnum(self, *args, objects=False, **kwargs):
+        if self.prefix_index is not None:
+            return self._lookup_index("lookup_inetnum", args, kwargs, objects)
+        return self._lookup_aux("lookup_inetnum", args, kwargs, objects)
+
+    def lookup_as_block(self, *args, objects=False, **kwargs):
+        return self._lookup_aux("lookup_as_block", args, kwargs, objects)
+
+    def lookup_domain(self, *args, objects=False, **kwargs):
+        return self._lookup_aux("lookup_domain", args, kwargs, objects)
+
+    def _lookup_aux(self, method, args, kwargs, objects):
+        def lookup(sess):
+            specs = list(getattr(sess, method)(*args, **kwargs))
+            if objects:
+                return list(sess.fetch_many(specs))
+            return specs
+        return self._read(lookup)
+
+    def lookup_inetnum_page(self, *args, **kwargs):
+        return self._read(
+            lambda sess: sess.lookup_inetnum_page(*args, **kwargs))
+
+    def search_inverse_page(self, *args, **kwargs):
+        return self._read(
+            lambda sess: sess.search_inverse_page(*args, **kwargs))
+
+    def lookup_route_many(self, *args, **kwargs):
+        return self._stream("lookup_route_many", *args, **kwargs)
 
-    def lookup_inetnum(self, *args, **kwargs):
+    def lookup_inetnum_many(self, *args, **kwargs):
+        return self._stream("lookup_inetnum_many", *args, **kwargs)
+
+    def _lookup_index(self, method, args, kwargs, objects):
+        self.prefix_index.maybe_refresh(self)
+        specs = getattr(self.prefix_index, method)(*args, **kwargs)
+        if objects:
+            return self.fetch_many(specs)
+        return specs
+
+    def load_prefix_index(self, refresh_interval=None):
+        index = lglass_sql.prefix.PrefixIndex(
+            refresh_interval=refresh_interval)
+        index.load(self)
+        self.prefix_index = index
+        return index
+
+    def search_inverse(self, *args, **kwargs):
+        return self._iterate("search_inverse", *args, **kwargs)
+
+    def changes_since(self, source, serial):
+        return self._stream("changes_since", source, serial)
+
+    def current_serial(self, source):
+        return self._read(lambda sess: sess.current_serial(source))
+
+    def bulk_import(self, objects, batch_size=5000, progress=None):
+        count = 0
+        start = time.monotonic()
+        objects = iter(objects)
+        self.invalid_specs = []
         with self.session() as sess:
-            return list(sess.lookup_inetnum(*args, **kwargs))
+            while True:
+                batch = list(itertools.islice(objects, batch_size))
+                if not batch:
+                    break
+                count += sess.save_many(batch, batch_size=batch_size)
+                self.invalid_specs.extend(sess.invalid_specs)
+                sess.commit()
+                if progress is not None:
+                    progress(count, count / (time.monotonic() - start))
+        elapsed = time.monotonic() - start
+        return count, count / elapsed if elapsed else 0.0
 
-    def lookup_as_block(self, *args, **kwargs):
+    def rebuild_indexes(self, workers=4, batch_size=10000, job="rebuild",
+                        resume=True, progress=None):
+        if self.dsn is None:
+            raise ValueError("rebuild_indexes requires a database with a DSN")
+        with self.session() as sess:
+            with sess.conn.cursor() as cur:
+                cur.execute("SELECT min(id), max(id) FROM object")
+                min_id, max_id = cur.fetchone()
+                if not resume:
+                    cur.execute("DELETE FROM rebuild_progress WHERE job = %s",
+                                (job,))
+                cur.execute(
+                    "SELECT lower, upper FROM rebuild_progress "
+                    "WHERE job = %s", (job,))
+                finished = set(cur.fetchall())
+            sess.commit()
+        if min_id is None:
+            return 0
+        ranges = [(lower, lower + batch_size) for lower
+                  in range(min_id - min_id % batch_size, max_id + 1,
+                           batch_size)]
+        pending = [r for r in ranges if r not in finished]
+        config = (self.dsn, self._connect_options, self._schema,
+                  self._database_name, self.storage)
+        count = 0
+        done = len(ranges) - len(pending)
+        self.invalid_ids = []
+        with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+            futures = [executor.submit(_rebuild_range, config, job, *r)
+                       for r in pending]
+            for future in concurrent.futures.as_completed(futures):
+                objects, invalid_ids = future.result()
+                count += objects
+                self.invalid_ids.extend(invalid_ids)
+                done += 1
+                if progress is not None:
+                    progress(done, len(ranges), count)
         with self.session() as sess:
-            return list(sess.lookup_as_block(*args, **kwargs))
+            with sess.conn.cursor() as cur:
+                cur.execute("DELETE FROM rebuild_progress WHERE job = %s",
+                            (job,))
+            sess.commit()
+        return count
+
+    def export(self, dest_dir, classes=None, workers=4, compress=True):
+        if classes is None:
+            classes = self.object_classes
+        os.makedirs(dest_dir, exist_ok=True)
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            futures = {class_: executor.submit(self._export_class, dest_dir,
+                                               class_, compress)
+                       for class_ in classes}
+            return {class_: future.result()
+                    for class_, future in futures.items()}
+
+    def _export_class(self, dest_dir, class_, compress):
+        filename = os.path.join(dest_dir, "{}.db.{}".format(
+            self._database_name or "lglass", class_.lower()))
+        if compress:
+            filename += ".gz"
+        # The dump is written under a temporary name, so that a failed
+        # export never leaves a truncated file under the final one
+        tmpname = "{}.tmp.{}".format(filename, os.getpid())
+        with self.session(readonly=True) as sess:
+            try:
+                if compress:
+                    fh = gzip.open(tmpname, "wt", encoding="utf-8")
+                else:
+                    fh = open(tmpname, "w", encoding="utf-8")
+                with fh:
+                    count = sess.export_class(class_, fh)
+                os.replace(tmpname, filename)
+            except BaseException:
+                if os.path.exists(tmpname):
+                    os.remove(tmpname)
+                raise
+        return count
 
     def _get_database_name(self):
         try:
@@ -63,95 +247,275 @@ class NicDatabase(lglass_sql.base.Database, lglass.nic.NicDatabaseMixin):
         self.save(self.manifest)
 
 
+def _field_positions(positions):
+    # Fill the None entries of a list of ascending positions with positions
+    # strictly between their neighbours, or renumber the whole list if there
+    # is no room left between them
+    positions = list(positions)
+    renumbered = [offset * POSITION_STEP for offset in range(len(positions))]
+    start = 0
+    while start < len(positions):
+        if positions[start] is not None:
+            start += 1
+            continue
+        end = start
+        while end < len(positions) and positions[end] is None:
+            end += 1
+        count = end - start
+        lower = positions[start - 1] if start > 0 else None
+        upper = positions[end] if end < len(positions) else None
+        if lower is None and upper is None:
+            return renumbered
+        if lower is None:
+            lower = upper - (count + 1) * POSITION_STEP
+        if upper is None:
+            upper = lower + (count + 1) * POSITION_STEP
+        if upper - lower <= count:
+            return renumbered
+        for offset in range(count):
+            positions[start + offset] = lower + \
+                (upper - lower) * (offset + 1) // (count + 1)
+        start = end
+    return positions
+
+
+def object_from_row(create_object, row):
+    id_, class_, key, last_modified, created, source, fields = row
+    obj = create_object(fields)
+    obj.sql_id = id_
+    if "last-modified" not in obj and last_modified:
+        obj.last_modified = last_modified
+    if "created" not in obj and created:
+        obj.created = created
+    if "source" not in obj and source:
+        obj.source = source
+    return obj
+
+
+def search_inverse_query(columns, inverse_keys, inverse_values, classes,
+                         after=None, limit=None):
+    def _map_value(val):
+        return val.lower().replace(" ", "")
+    query = "SELECT " + columns + " FROM inverse_field " \
+            "JOIN object ON object.id = object_id " \
+            "WHERE inverse_field.key IN %(keys)s " \
+            "AND inverse_field.value IN %(values)s " \
+            "AND lower(object.class) IN %(classes)s "
+    if after is not None:
+        query += "AND (inverse_field.key, inverse_field.value, " \
+                 "inverse_field.object_id) > " \
+                 "(%(after_key)s, %(after_value)s, %(after_id)s) "
+    query += "ORDER BY inverse_field.key, inverse_field.value, " \
+             "inverse_field.object_id LIMIT %(limit)s"
+    params = {"keys": tuple(inverse_keys),
+              "values": tuple(map(_map_value, inverse_values)),
+              "classes": tuple(map(str.lower, classes)),
+              "limit": limit}
+    if after is not None:
+        params["after_key"], params["after_value"], params["after_id"] = \
+            after
+    return query, params
+
+
+INETNUM_RELATIONS = {">>": "sup", ">>=": "supeq", "<<": "sub",
+                     "<<=": "subeq"}
+
+
+def _inetnum_statement_name(relation, order):
+    return "lglass_lookup_inetnum_{}_{}".format(
+        INETNUM_RELATIONS[relation], order.lower())
+
+
+def _check_inetnum_args(relation, order):
+    if order not in {'ASC', 'DESC'}:
+        raise ValueError("{!r} is not a valid order, must be one "
+                         "of 'ASC' or 'DESC'".format(order))
+    if relation not in INETNUM_RELATIONS:
+        raise ValueError("{!r} is not a valid relation, must be one "
+                         "of '>>', '>>=', '<<' or '<<='".format(relation))
+
+
+def _inetnum_condition(relation, addr):
+    if relation in {'>>=', '<<='}:
+        return "(address {relation} {addr} OR address = {addr})".format(
+            relation=relation[:-1], addr=addr)
+    return "address {relation} {addr}".format(relation=relation, addr=addr)
+
+
+def _inetnum_statement(relation, order):
+    return "SELECT object.class, object.key FROM inetnum, object " \
+           "WHERE object.id = inetnum.object_id AND {condition} " \
+           "ORDER BY masklen(address) {order}, address " \
+           "LIMIT $2".format(
+               condition=_inetnum_condition(relation, "$1::inet"),
+               order=order)
+
+
+NIC_STATEMENTS = {
+    "lglass_nic_fetch":
+        "SELECT object.id, object.source, object.last_modified, "
+        "object.created, object_field.key, object_field.value "
+        "FROM object, object_field "
+        "WHERE object.id = object_field.object_id "
+        "AND lower(object.class) = lower($1) "
+        "AND lower(object.key) = lower($2) "
+        "ORDER BY object_field.position",
+    "lglass_lookup_route":
+        "SELECT object.class, object.key FROM route "
+        "LEFT JOIN object ON object.id = object_id "
+        "WHERE address >> $1::inet OR address = $1::inet "
+        "ORDER BY masklen(address) DESC "
+        "LIMIT $2",
+    "lglass_lookup_as_block":
+        "SELECT object.class, object.key FROM as_block "
+        "LEFT JOIN object ON object.id = object_id "
+        "WHERE range @> ($1::int8) "
+        "ORDER BY (upper(range) - lower(range)) DESC",
+    "lglass_lookup_domain":
+        "SELECT object.class, object.key FROM domain "
+        "LEFT JOIN object ON object.id = object_id "
+        "WHERE reverse(name) LIKE $1 "
+        "ORDER BY name"
+}
+
+NIC_STATEMENTS.update(
+    (_inetnum_statement_name(relation, order),
+     _inetnum_statement(relation, order))
+    for relation in INETNUM_RELATIONS for order in ('ASC', 'DESC'))
+
+
 class NicSession(lglass_sql.base.Session):
+    statements = dict(lglass_sql.base.Session.statements, **NIC_STATEMENTS)
+
     def create_object(self, *args, **kwargs):
         return self.backend.create_object(*args, **kwargs)
 
     def search_inverse(self, inverse_keys, inverse_values,
-                       classes=None, keys=None):
-        def _map_value(val):
-            return val.lower().replace(" ", "")
+                       classes=None, keys=None, objects=True):
         if classes is None:
             classes = self.object_classes
-        with self.conn.cursor() as cur:
-            cur.execute(
-                "SELECT object.class, object.key FROM inverse_field "
-                "LEFT JOIN object ON object.id = object_id "
-                "WHERE inverse_field.key IN %(keys)s "
-                "AND inverse_field.value IN %(values)s "
-                "ORDER BY inverse_field.value",
-                {"keys": tuple(inverse_keys),
-                 "values": tuple(map(_map_value, inverse_values))})
-            for class_, key in cur:
-                if class_ in classes:
-                    yield self.fetch(class_, key)
+        if objects:
+            columns = self.object_columns
+        else:
+            columns = "object.class, object.key"
+        with self._stream_cursor("search_inverse") as cur:
+            cur.execute(*search_inverse_query(columns, inverse_keys,
+                                              inverse_values, classes))
+            if objects:
+                yield from map(self._object_from_row, cur)
+            else:
+                yield from cur
+
+    def _search_condition(self, key, values, classes):
+        # Inverse keys match ignoring case and spaces, like inverse_field,
+        # also for searched classes that do not index the key there
+        inverse = self._inverse_classes(key, classes)
+        if not inverse:
+            return super()._search_condition(key, values, classes)
+        values = tuple(v.lower().replace(" ", "") for v in values)
+        condition = ("EXISTS (SELECT 1 FROM inverse_field AS i "
+                     "WHERE i.object_id = object.id AND i.key = %s "
+                     "AND i.value IN %s)")
+        if inverse == {class_.lower() for class_ in classes}:
+            return condition, (key, values)
+        fallback, fallback_params = self._field_condition(key, values,
+                                                          fold=True)
+        inverse = tuple(sorted(inverse))
+        return ("(lower(object.class) IN %s AND " + condition + " OR "
+                "lower(object.class) NOT IN %s AND " + fallback + ")",
+                (inverse, key, values, inverse) + fallback_params)
+
+    def _inverse_classes(self, key, classes):
+        # Ask the object schema through inverse_fields() on a probe object
+        # of each class, so the answer does not depend on table contents
+        inverse_keys = self.backend._inverse_keys
+        inverse = set()
+        for class_ in classes:
+            class_ = class_.lower()
+            if (class_, key) not in inverse_keys:
+                try:
+                    probe = self.create_object([(class_, "probe"),
+                                                (key, "probe")])
+                    fields = {k for k, _ in probe.inverse_fields()}
+                except (ValueError, KeyError, AttributeError):
+                    fields = set()
+                inverse_keys[class_, key] = key in fields
+            if inverse_keys[class_, key]:
+                inverse.add(class_)
+        return inverse
 
     def lookup_route(self, address, limit=None):
-        address = str(address)
-        with self.conn.cursor() as cur:
-            cur.execute(
-                "SELECT object.class, object.key FROM route "
-                "LEFT JOIN object ON object.id = object_id "
-                "WHERE address >> %(addr)s OR address = %(addr)s "
-                "ORDER BY masklen(address) DESC "
-                "LIMIT %(limit)s", {"addr": address,
-                                    "limit": limit})
+        with self._cursor("lookup_route") as cur:
+            self._execute(cur, "lglass_lookup_route", (str(address), limit))
             yield from cur
 
     def lookup_inetnum(self, address, relation='>>=', limit=None,
                        order='DESC'):
-        address = str(address)
-        objs = []
-        if order not in {'ASC', 'DESC'}:
-            raise ValueError("{!r} is not a valid order, must be one "
-                             "of 'ASC' or 'DESC'".format(order))
-        if relation not in {'>>', '<<', '>>=', '<<='}:
-            raise ValueError("{!r} is not a valid relation, must be one "
-                             "of '>>', '>>=', '<<' or '<<='".format(relation))
-        query = "SELECT object.class, object.key FROM inetnum, object " \
-                "WHERE object.id = inetnum.object_id "
-        if relation in {'>>=', '<<='}:
-            relation = relation[:-1]
-            query += "AND (address {relation} %(addr)s " \
-                     "OR address = %(addr)s) ".format(relation=relation)
-        else:
-            query += "AND address {relation} %(addr)s ".format(
-                    relation=relation)
-        query += "ORDER BY masklen(address) {order}, address " \
-                 "LIMIT %(limit)s".format(order=order)
-        with self.conn.cursor() as cur:
-            cur.execute(query, {"addr": str(address), "limit": limit})
+        _check_inetnum_args(relation, order)
+        with self._cursor("lookup_inetnum") as cur:
+            self._execute(cur, _inetnum_statement_name(relation, order),
+                          (str(address), limit))
             yield from cur
 
+    def lookup_route_many(self, addresses, limit=None, chunk_size=1000):
+        query = "SELECT a.n, m.class, m.key " \
+                "FROM unnest(%(addrs)s::inet[]) " \
+                "WITH ORDINALITY AS a (addr, n) " \
+                "LEFT JOIN LATERAL (SELECT object.class, object.key, " \
+                "masklen(route.address) AS len FROM route " \
+                "JOIN object ON object.id = route.object_id " \
+                "WHERE route.address >>= a.addr " \
+                "ORDER BY masklen(route.address) DESC LIMIT %(limit)s) AS m " \
+                "ON true ORDER BY a.n, m.len DESC"
+        yield from self._lookup_many(query, addresses, limit, chunk_size)
+
+    def lookup_inetnum_many(self, addresses, relation='>>=', limit=None,
+                            order='DESC', chunk_size=1000):
+        _check_inetnum_args(relation, order)
+        query = "SELECT a.n, m.class, m.key " \
+                "FROM unnest(%(addrs)s::inet[]) " \
+                "WITH ORDINALITY AS a (addr, n) " \
+                "LEFT JOIN LATERAL (SELECT object.class, object.key, " \
+                "inetnum.address FROM inetnum " \
+                "JOIN object ON object.id = inetnum.object_id " \
+                "WHERE {condition} " \
+                "ORDER BY masklen(inetnum.address) {order}, inetnum.address " \
+                "LIMIT %(limit)s) AS m ON true " \
+                "ORDER BY a.n, masklen(m.address) {order}, m.address".format(
+                    condition=_inetnum_condition(relation, "a.addr"),
+                    order=order)
+        yield from self._lookup_many(query, addresses, limit, chunk_size)
+
+    def _lookup_many(self, query, addresses, limit, chunk_size):
+        addresses = iter(addresses)
+        while True:
+            chunk = list(itertools.islice(addresses, chunk_size))
+            if not chunk:
+                break
+            with self._cursor("lookup_many") as cur:
+                cur.execute(query, {"addrs": list(map(str, chunk)),
+                                    "limit": limit})
+                for n, rows in itertools.groupby(cur, key=lambda r: r[0]):
+                    yield chunk[n - 1], [(class_, key) for _, class_, key
+                                         in rows if class_ is not None]
+
     def lookup_as_block(self, asn):
-        with self.conn.cursor() as cur:
-            cur.execute(
-                "SELECT object.class, object.key FROM as_block "
-                "LEFT JOIN object ON object.id = object_id "
-                "WHERE range @> (%s::int8) "
-                "ORDER BY (upper(range) - lower(range)) DESC", (asn,))
+        with self._cursor("lookup_as_block") as cur:
+            self._execute(cur, "lglass_lookup_as_block", (asn,))
             yield from cur
 
     def lookup_domain(self, domain):
-        with self.conn.cursor() as cur:
-            cur.execute(
-                "SELECT object.class, object.key FROM domain "
-                "LEFT JOIN object ON object.id = object_id "
-                "WHERE reverse(name) LIKE %s "
-                "ORDER BY name", (domain[::-1] + '%',))
+        with self._cursor("lookup_domain") as cur:
+            self._execute(cur, "lglass_lookup_domain", (domain[::-1] + '%',))
             yield from cur
 
-    def fetch(self, class_, key):
-        with self.conn.cursor() as cur:
-            cur.execute(
-                "SELECT object.id, object.source, object.last_modified, "
-                "object.created, object_field.key, object_field.value "
-                "FROM object, object_field "
-                "WHERE object.id = object_field.object_id "
-                "AND lower(object.class) = lower(%s) "
-                "AND lower(object.key) = lower(%s) "
-                "ORDER BY object_field.position",
-                (class_, key))
+    def fetch(self, class_, key, fields=None, lazy=False):
+        if fields is not None:
+            return self._fetch_projected(class_, key, fields, lazy)
+        if self.storage == "compact":
+            return self._fetch_compact(class_, key)
+        with self._cursor("fetch") as cur:
+            self._execute(cur, "lglass_nic_fetch", (class_, key))
             if not cur.rowcount:
                 raise KeyError(repr((class_, key)))
             obj_id, source, last_modified, created, fkey, fval = cur.fetchone()
@@ -166,113 +530,516 @@ class NicSession(lglass_sql.base.Session):
             obj.source = source
         return obj
 
-    def fetch_by_id(self, object_id):
-        return self.create_object(super().fetch_by_id(object_id))
-    
-    def find(self, filter=None, classes=None, keys=None):
-        if not classes:
+    def _object_from_row(self, row):
+        return object_from_row(self.create_object, row)
+
+    def lookup_inetnum_page(self, address, relation='<<=', after=None,
+                            limit=100):
+        _check_inetnum_args(relation, 'ASC')
+        query = "SELECT inetnum.address, object.class, object.key " \
+                "FROM inetnum, object " \
+                "WHERE object.id = inetnum.object_id AND {condition} " \
+                .format(condition=_inetnum_condition(relation,
+                                                     "%(addr)s::inet"))
+        params = {"addr": str(address), "limit": limit + 1}
+        if after:
+            query += "AND inetnum.address > %(after)s::cidr "
+            params["after"] = lglass_sql.base.decode_token(after)[0]
+        query += "ORDER BY inetnum.address LIMIT %(limit)s"
+        with self._cursor("lookup_inetnum_page") as cur:
+            cur.execute(query, params)
+            rows, token = self._page(cur, limit, lambda r: [r[0]])
+        return [(class_, key) for _, class_, key in rows], token
+
+    def search_inverse_page(self, inverse_keys, inverse_values, classes=None,
+                            after=None, limit=100, objects=True):
+        if classes is None:
             classes = self.object_classes
-        classes = tuple(classes)
-        query_keys = tuple()
-        query =  ("SELECT object.id, object.class, object.key, "
-                 "object.last_modified, object.created, object.source, "
-                 "ARRAY(SELECT ARRAY[f.key, f.value] FROM object_field "
-                 "AS f WHERE f.object_id = object.id ORDER BY f.position) "
-            "FROM object WHERE lower(class) IN %(classes)s ")
-        if keys and not callable(keys):
-            query += "AND lower(key) IN %(keys)s"
-            query_keys = tuple(map(str.lower, keys))
-        with self.conn.cursor() as cur:
-            cur.execute(query, {"classes": classes, "keys": query_keys})
-            for id_, class_, key, last_modified, created, source, obj in cur:
-                if callable(keys) and not keys(key):
-                    continue
-                obj = self.create_object(obj)
-                obj.sql_id = id_
-                if "last-modified" not in obj and last_modified:
-                    obj.last_modified = last_modified
-                if "created" not in obj and created:
-                    obj.created = created
-                if "source" not in obj and source:
-                    obj.source = source
-                if callable(filter) and not filter(obj):
+        if objects:
+            columns = self.object_columns
+        else:
+            columns = "object.class, object.key"
+        columns += ", inverse_field.key, inverse_field.value, " \
+                   "inverse_field.object_id"
+        with self._cursor("search_inverse_page") as cur:
+            cur.execute(*search_inverse_query(
+                columns, inverse_keys, inverse_values, classes,
+                after=lglass_sql.base.decode_token(after) if after else None,
+                limit=limit + 1))
+            rows, token = self._page(cur, limit, lambda r: list(r[-3:]))
+        if objects:
+            return [self._object_from_row(row[:-3]) for row in rows], token
+        return [tuple(row[:-3]) for row in rows], token
+
+    def rebuild_range(self, lower, upper):
+        with self._cursor("rebuild_range") as cur:
+            for table in AUX_UPSERT:
+                cur.execute(
+                    "DELETE FROM {} WHERE object_id >= %s "
+                    "AND object_id < %s".format(table), (lower, upper))
+            cur.execute(
+                "DELETE FROM inverse_field WHERE object_id >= %s "
+                "AND object_id < %s", (lower, upper))
+            cur.execute(
+                "SELECT " + self.object_columns + " FROM object "
+                "WHERE id >= %s AND id < %s", (lower, upper))
+            objs = [self._object_from_row(row) for row in cur.fetchall()]
+            aux = {table: {} for table in AUX_UPSERT}
+            inverse = []
+            self.invalid_ids = []
+            for obj in objs:
+                try:
+                    table, record = self._aux_record(obj)
+                    records = self._inverse_records(obj)
+                except (ValueError, KeyError, IndexError, TypeError,
+                        AttributeError):
+                    self.invalid_ids.append(obj.sql_id)
                     continue
-                yield obj
+                if table is not None:
+                    # One row per conflict key, ON CONFLICT must not hit
+                    # the same row twice within a statement
+                    conflict = record
+                    if table == "domain":
+                        conflict = (record[0].lower(),)
+                    aux[table][conflict] = (obj.sql_id,) + record
+                inverse.extend((obj.sql_id, key, value)
+                               for key, value in records)
+            for table, rows in aux.items():
+                if rows:
+                    pg.extras.execute_values(
+                        cur, AUX_UPSERT[table], list(rows.values()),
+                        template=AUX_TEMPLATES[table])
+            pg.extras.execute_values(
+                cur,
+                "INSERT INTO inverse_field (object_id, key, value) "
+                "VALUES %s ON CONFLICT DO NOTHING", inverse)
+        if self.invalid_ids:
+            logger.warning("skipped %d invalid objects in range [%d, %d): "
+                           "%r", len(self.invalid_ids), lower, upper,
+                           self.invalid_ids)
+        return len(objs) - len(self.invalid_ids)
 
+    def export_class(self, class_, fh):
+        if self.storage == "compact":
+            query = "SELECT o.id, o.fields[i][1], o.fields[i][2] " \
+                    "FROM object AS o, " \
+                    "generate_subscripts(o.fields, 1) AS i " \
+                    "WHERE lower(o.class) = lower(%s) ORDER BY o.id, i"
+        else:
+            query = "SELECT o.id, f.key, f.value FROM object AS o " \
+                    "JOIN object_field AS f ON f.object_id = o.id " \
+                    "WHERE lower(o.class) = lower(%s) " \
+                    "ORDER BY o.id, f.position"
+        writer = lglass_sql.export.RPSLWriter(fh)
+        with self._cursor("export_class") as cur:
+            cur.copy_expert("COPY ({}) TO STDOUT".format(
+                cur.mogrify(query, (class_,)).decode()), writer)
+        writer.close()
+        return writer.objects
 
     def reindex(self, obj):
         obj_id = obj.sql_id
-        with self.conn.cursor() as cur:
+        with self._cursor("reindex") as cur:
             self._save_inverse(obj, obj_id, cur)
 
-    def save(self, obj, **options):
+    def save(self, obj, status=False, **options):
         obj = self.create_object(obj)
-        with self.conn.cursor() as cur:
-            obj_id = self._save_raw_object(obj, cur)
-            self._save_aux(obj, obj_id, cur)
-            self._save_inverse(obj, obj_id, cur)
+        self._written(self.primary_spec(obj))
+        with self._cursor("save") as cur:
+            obj_id, state = self._save_raw_object(obj, cur)
+            if state != UNCHANGED:
+                self._save_aux(obj, obj_id, cur)
+                self._save_inverse(obj, obj_id, cur)
+                self._journal(cur, obj.source, "ADD",
+                              *self.primary_spec(obj), obj_id=obj_id)
+        if status:
+            return obj_id, state
         return obj_id
 
+    def delete(self, obj):
+        self.delete_by_spec(*self.primary_spec(obj))
+
+    def delete_by_spec(self, primary_class, primary_key):
+        self._delete("delete", "lower(class) = lower(%s) "
+                     "AND lower(key) = lower(%s)",
+                     (primary_class, primary_key),
+                     repr((primary_class, primary_key)))
+
+    def delete_by_id(self, object_id):
+        self._delete("delete_by_id", "id = %s", (object_id,), object_id)
+
+    def _delete(self, label, condition, params, missing):
+        with self._cursor(label) as cur:
+            cur.execute(
+                "DELETE FROM object WHERE " + condition +
+                " RETURNING id, class, key, source", params)
+            row = cur.fetchone()
+            if row is None:
+                raise KeyError(missing)
+            self._journal(cur, row[3], "DEL", row[1], row[2], obj_id=row[0])
+        self._written((row[1], row[2]), row[0])
+
+    def _journal(self, cur, source, operation, class_, key, obj_id=None):
+        source = source or DEFAULT_SOURCE
+        cur.execute(
+            "INSERT INTO source (name, serial) VALUES (%s, 1) "
+            "ON CONFLICT (lower(name)) DO UPDATE SET "
+            "serial = source.serial + 1 RETURNING name, serial", (source,))
+        name, serial = cur.fetchone()
+        cur.execute(
+            "INSERT INTO journal (source, serial, operation, class, key, "
+            "object_id) VALUES (%s, %s, %s, lower(%s), lower(%s), %s)",
+            (name, serial, operation, class_, key, obj_id))
+        return serial
+
+    def changes_since(self, source, serial):
+        with self._stream_cursor("changes_since") as cur:
+            cur.execute(
+                "SELECT serial, operation, class, key FROM journal "
+                "WHERE lower(source) = lower(%s) AND serial > %s "
+                "ORDER BY serial", (source, serial))
+            yield from cur
+
+    def current_serial(self, source):
+        with self._cursor("current_serial") as cur:
+            cur.execute(
+                "SELECT serial FROM source WHERE lower(name) = lower(%s)",
+                (source,))
+            row = cur.fetchone()
+            return row[0] if row is not None else 0
+
     def _save_raw_object(self, obj, cur):
         primary_class, primary_key = self.primary_spec(obj)
+        digest = object_digest(obj)
+        cur.execute(
+            "SELECT id, digest FROM object WHERE lower(class) = lower(%s) "
+            "AND lower(key) = lower(%s)", (primary_class, primary_key))
+        row = cur.fetchone()
+        if row is not None and row[1] == digest:
+            return row[0], UNCHANGED
+        params = {"class": primary_class, "key": primary_key,
+                  "source": obj.source, "created": obj.created,
+                  "last_modified": obj.last_modified, "digest": digest}
+        columns = values = updates = ""
+        if self.storage == "compact":
+            # The fields are part of the upsert, so a save writes a single
+            # row version
+            columns, values = ", fields", ", %(fields)s"
+            updates = ", fields = %(fields)s"
+            params["fields"] = [list(line) for line in obj.data]
         cur.execute(
             "INSERT INTO object (class, key, source, created, "
-            "last_modified) VALUES (lower(%(class)s), lower(%(key)s), "
-            "%(source)s, %(created)s, %(last_modified)s) ON CONFLICT "
+            "last_modified, digest" + columns + ") VALUES (lower(%(class)s), "
+            "lower(%(key)s), %(source)s, %(created)s, %(last_modified)s, "
+            "%(digest)s" + values + ") ON CONFLICT "
             "(lower(class), lower(key)) DO UPDATE SET "
             "source = %(source)s, created = %(created)s, "
-            "last_modified = %(last_modified)s RETURNING id",
-            {"class": primary_class, "key": primary_key,
-             "source": obj.source, "created": obj.created,
-             "last_modified": obj.last_modified})
-        obj_id = cur.fetchone()[0]
+            "last_modified = %(last_modified)s, digest = %(digest)s" +
+            updates + " "
+            # xmax is an undocumented system column, it is 0 only for a
+            # freshly inserted row. The SELECT above cannot tell, as a
+            # concurrent save may insert the object in between.
+            "RETURNING id, xmax = 0", params)
+        obj_id, inserted = cur.fetchone()
+        if self.storage == "compact":
+            return obj_id, INSERTED if inserted else UPDATED
+        if inserted:
+            pg.extras.execute_values(
+                cur, "INSERT INTO object_field "
+                "(key, value, object_id, position) VALUES %s",
+                [(line[0], line[1], obj_id, offset * POSITION_STEP)
+                 for offset, line in enumerate(obj.data)])
+            return obj_id, INSERTED
+        self._save_fields_diff(obj, obj_id, cur)
+        return obj_id, UPDATED
+
+    def _save_fields_diff(self, obj, obj_id, cur):
         cur.execute(
-            "DELETE FROM object_field WHERE object_id = %s", (obj_id,))
-        pg.extras.execute_values(
-            cur, "INSERT INTO object_field "
-            "(key, value, object_id, position) VALUES %s "
-            "RETURNING id",
-            [(line[0], line[1], obj_id, offset)
-             for offset, line in enumerate(obj.data)])
-        return obj_id
+            "SELECT id, key, value, position FROM object_field "
+            "WHERE object_id = %s ORDER BY position", (obj_id,))
+        old = cur.fetchall()
+        new = [(line[0], line[1]) for line in obj.data]
+        # Match old rows to new lines, so that inserting or removing a line
+        # leaves the rows of the other lines untouched
+        rows = [None] * len(new)
+        deleted = []
+        matcher = difflib.SequenceMatcher(
+            None, [(row[1], row[2]) for row in old], new, autojunk=False)
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            kept = min(i2 - i1, j2 - j1) if tag != "delete" else 0
+            rows[j1:j1 + kept] = old[i1:i1 + kept]
+            deleted.extend(row[0] for row in old[i1 + kept:i2])
+        positions = _field_positions(
+            [row[3] if row is not None else None for row in rows])
+        updated = [(key, value, position, row[0]) for (key, value), row,
+                   position in zip(new, rows, positions)
+                   if row is not None and
+                   (row[1], row[2], row[3]) != (key, value, position)]
+        inserted = [(key, value, obj_id, position) for (key, value), row,
+                    position in zip(new, rows, positions) if row is None]
+        if deleted:
+            cur.execute("DELETE FROM object_field WHERE id IN %s",
+                        (tuple(deleted),))
+        if updated:
+            pg.extras.execute_values(
+                cur, "UPDATE object_field SET key = data.key, "
+                "value = data.value, position = data.position "
+                "FROM (VALUES %s) AS data (key, value, position, id) "
+                "WHERE object_field.id = data.id", updated)
+        if inserted:
+            pg.extras.execute_values(
+                cur, "INSERT INTO object_field "
+                "(key, value, object_id, position) VALUES %s", inserted)
 
-    def _save_aux(self, obj, obj_id, cur):
+    def _aux_record(self, obj):
         if obj.object_class in {"inetnum", "inet6num"}:
-            cur.execute(
-                "INSERT INTO inetnum (object_id, address) VALUES "
-                "(%(obj_id)s, %(addr)s) ON CONFLICT (address) "
-                "DO UPDATE SET object_id = %(obj_id)s",
-                {"obj_id": obj_id, "addr": str(obj.ip_network)})
+            return "inetnum", (str(obj.ip_network),)
         elif obj.object_class in {"route", "route6"}:
-            cur.execute(
-                "INSERT INTO route (object_id, address, asn) "
-                "VALUES (%(obj_id)s, %(addr)s, %(asn)s) ON CONFLICT "
-                "(address, asn) DO UPDATE SET object_id = %(obj_id)s",
-                {"obj_id": obj_id, "addr": str(obj.ip_network),
-                 "asn": obj.origin[2:].split()[0]})
+            return "route", (str(obj.ip_network),
+                             obj.origin[2:].split()[0])
         elif obj.object_class == "as-block":
-            cur.execute(
-                "INSERT INTO as_block (object_id, range) VALUES "
-                "(%(obj_id)s, %(range)s) ON CONFLICT (range) "
-                "DO UPDATE SET object_id = %(obj_id)s",
-                {"obj_id": obj_id, "range": pg.extras.NumericRange(
-                    obj.start,
-                    obj.end, '[]')})
+            return "as_block", (obj.start, obj.end)
         elif obj.object_class == "domain":
-            cur.execute(
-                "INSERT INTO domain (object_id, name) "
-                "VALUES (%(obj_id)s, lower(%(name)s)) "
-                "ON CONFLICT (name) DO UPDATE SET "
-                "object_id = %(obj_id)s",
-                {"obj_id": obj_id, "name": obj.primary_key})
+            return "domain", (obj.primary_key,)
+        return None, None
+
+    def _save_aux(self, obj, obj_id, cur):
+        table, record = self._aux_record(obj)
+        if table is not None:
+            pg.extras.execute_values(cur, AUX_UPSERT[table],
+                                     [(obj_id,) + record],
+                                     template=AUX_TEMPLATES[table])
+
+    def _inverse_records(self, obj):
+        return {(key, value.lower().replace(" ", ""))
+                for key, value in obj.inverse_fields()}
 
     def _save_inverse(self, obj, obj_id, cur):
         cur.execute(
-            "DELETE FROM inverse_field WHERE object_id = %s", (obj_id,))
-        inverse_fields = [(obj_id, key, value.lower().replace(" ", ""))
-                for key, value
-                          in obj.inverse_fields()]
+            "SELECT key, value FROM inverse_field WHERE object_id = %s",
+            (obj_id,))
+        old = set(cur.fetchall())
+        new = self._inverse_records(obj)
+        if old - new:
+            cur.execute(
+                "DELETE FROM inverse_field WHERE object_id = %s "
+                "AND (key, value) IN %s", (obj_id, tuple(old - new)))
         pg.extras.execute_values(
             cur,
             "INSERT INTO inverse_field (object_id, key, value) VALUES %s "
-            "ON CONFLICT DO NOTHING", inverse_fields)
+            "ON CONFLICT DO NOTHING",
+            [(obj_id, key, value) for key, value in new - old])
+
+    def save_many(self, objects, batch_size=5000):
+        count = 0
+        objects = iter(objects)
+        self.invalid_specs = []
+        with self._cursor("save_many") as cur:
+            for statement in STAGING_TABLES:
+                cur.execute(statement)
+            while True:
+                batch = list(itertools.islice(objects, batch_size))
+                if not batch:
+                    break
+                count += self._stage_objects(batch, cur)
+                self._merge_staged(cur)
+        if self.invalid_specs:
+            logger.warning("skipped %d invalid objects: %r",
+                           len(self.invalid_specs), self.invalid_specs)
+        return count
+
+    def _stage_objects(self, objects, cur):
+        staged = {"object": [], "field": [], "inverse": [], "route": [],
+                  "inetnum": [], "as_block": [], "domain": []}
+        count = 0
+        for seq, obj in enumerate(objects):
+            spec = None
+            try:
+                obj = self.create_object(obj)
+                spec = self.primary_spec(obj)
+                digest = object_digest(obj)
+                records = self._inverse_records(obj)
+                table, record = self._aux_record(obj)
+            except (ValueError, KeyError, IndexError, TypeError,
+                    AttributeError):
+                self.invalid_specs.append(spec)
+                continue
+            self._written(spec)
+            staged["object"].append((seq, spec[0], spec[1], obj.source,
+                                     obj.created, obj.last_modified,
+                                     digest))
+            staged["field"].extend((seq, offset * POSITION_STEP, line[0],
+                                    line[1])
+                                   for offset, line in enumerate(obj.data))
+            staged["inverse"].extend((seq, key, value)
+                                     for key, value in records)
+            if table is not None:
+                staged[table].append((seq,) + record)
+            count += 1
+        for table, rows in staged.items():
+            lglass_sql.base.copy_rows(cur, "staging_" + table,
+                                      STAGING_COLUMNS[table], rows)
+        return count
+
+    def _merge_staged(self, cur):
+        statements = STAGING_MERGE
+        if self.storage == "compact":
+            statements = STAGING_MERGE_COMPACT
+        for statement in statements:
+            cur.execute(statement)
+        for table in STAGING_COLUMNS:
+            cur.execute("TRUNCATE staging_" + table)
+
+
+def _rebuild_range(config, job, lower, upper):
+    dsn, connect_options, schema, database_name, storage = config
+    db = NicDatabase(dsn, connect_options=connect_options, schema=schema,
+                     database_name=database_name, storage=storage)
+    with db.session() as sess:
+        count = sess.rebuild_range(lower, upper)
+        with sess.conn.cursor() as cur:
+            cur.execute(
+                "INSERT INTO rebuild_progress (job, lower, upper, objects) "
+                "VALUES (%s, %s, %s, %s)", (job, lower, upper, count))
+        sess.commit()
+    return count, sess.invalid_ids
+
+
+AUX_UPSERT = {
+    "inetnum": "INSERT INTO inetnum (object_id, address) VALUES %s "
+               "ON CONFLICT (address) DO UPDATE SET "
+               "object_id = EXCLUDED.object_id "
+               "WHERE inetnum.object_id <> EXCLUDED.object_id",
+    "route": "INSERT INTO route (object_id, address, asn) "
+             "VALUES %s ON CONFLICT (address, asn) "
+             "DO UPDATE SET object_id = EXCLUDED.object_id "
+             "WHERE route.object_id <> EXCLUDED.object_id",
+    "as_block": "INSERT INTO as_block (object_id, range) "
+                "VALUES %s ON CONFLICT (range) "
+                "DO UPDATE SET object_id = EXCLUDED.object_id "
+                "WHERE as_block.object_id <> EXCLUDED.object_id",
+    "domain": "INSERT INTO domain (object_id, name) "
+              "VALUES %s ON CONFLICT (name) "
+              "DO UPDATE SET object_id = EXCLUDED.object_id "
+              "WHERE domain.object_id <> EXCLUDED.object_id"
+}
+
+AUX_TEMPLATES = {
+    "inetnum": "(%s, %s)",
+    "route": "(%s, %s, %s)",
+    "as_block": "(%s, int8range(%s, %s, '[]'))",
+    "domain": "(%s, lower(%s))"
+}
+
+STAGING_COLUMNS = {
+    "object": ("seq", "class", "key", "source", "created", "last_modified",
+               "digest"),
+    "field": ("seq", "position", "key", "value"),
+    "inverse": ("seq", "key", "value"),
+    "route": ("seq", "address", "asn"),
+    "inetnum": ("seq", "address"),
+    "as_block": ("seq", "lower", "upper"),
+    "domain": ("seq", "name")
+}
+
+STAGING_TABLES = [
+    "CREATE TEMPORARY TABLE IF NOT EXISTS staging_object ("
+    "seq integer, class varchar, key varchar, source varchar, "
+    "created timestamp, last_modified timestamp, digest varchar, "
+    "object_id integer)",
+    "CREATE TEMPORARY TABLE IF NOT EXISTS staging_field ("
+    "seq integer, position integer, key varchar, value text)",
+    "CREATE TEMPORARY TABLE IF NOT EXISTS staging_inverse ("
+    "seq integer, key varchar, value varchar)",
+    "CREATE TEMPORARY TABLE IF NOT EXISTS staging_route ("
+    "seq integer, address cidr, asn bigint)",
+    "CREATE TEMPORARY TABLE IF NOT EXISTS staging_inetnum ("
+    "seq integer, address cidr)",
+    "CREATE TEMPORARY TABLE IF NOT EXISTS staging_as_block ("
+    "seq integer, lower int8, upper int8)",
+    "CREATE TEMPORARY TABLE IF NOT EXISTS staging_domain ("
+    "seq integer, name varchar)"
+]
+
+STAGING_FIELDS = [
+    "DELETE FROM object_field WHERE object_id IN "
+    "(SELECT object_id FROM staging_object)",
+    "INSERT INTO object_field (key, value, object_id, position) "
+    "SELECT f.key, f.value, s.object_id, f.position "
+    "FROM staging_field AS f JOIN staging_object AS s USING (seq)"
+]
+
+STAGING_FIELDS_COMPACT = [
+    "UPDATE object SET fields = f.fields FROM (SELECT s.object_id, "
+    "array_agg(ARRAY[f.key::text, f.value] ORDER BY f.position) AS fields "
+    "FROM staging_field AS f JOIN staging_object AS s USING (seq) "
+    "GROUP BY s.object_id) AS f WHERE object.id = f.object_id"
+]
+
+STAGING_MERGE = [
+    # Only the last occurrence of an object within a batch is kept
+    "DELETE FROM staging_object AS s USING staging_object AS t "
+    "WHERE lower(s.class) = lower(t.class) AND lower(s.key) = lower(t.key) "
+    "AND s.seq < t.seq",
+    "DELETE FROM staging_object AS s USING object AS o "
+    "WHERE lower(o.class) = lower(s.class) AND lower(o.key) = lower(s.key) "
+    "AND o.digest = s.digest",
+    "WITH ins AS (INSERT INTO object (class, key, source, created, "
+    "last_modified, digest) SELECT lower(class), lower(key), source, "
+    "created, last_modified, digest FROM staging_object ON CONFLICT "
+    "(lower(class), lower(key)) DO UPDATE SET source = EXCLUDED.source, "
+    "created = EXCLUDED.created, last_modified = EXCLUDED.last_modified, "
+    "digest = EXCLUDED.digest RETURNING id, class, key) "
+    "UPDATE staging_object AS s SET object_id = ins.id FROM ins "
+    "WHERE lower(ins.class) = lower(s.class) "
+    "AND lower(ins.key) = lower(s.key)",
+    "UPDATE staging_object SET source = '{}' "
+    "WHERE source IS NULL".format(DEFAULT_SOURCE),
+    "INSERT INTO source (name, serial) "
+    "SELECT DISTINCT ON (lower(source)) source, 0 FROM staging_object "
+    "WHERE source IS NOT NULL ORDER BY lower(source) "
+    "ON CONFLICT (lower(name)) DO NOTHING",
+    "WITH counts AS (SELECT lower(source) AS name, count(*) AS n "
+    "FROM staging_object WHERE source IS NOT NULL GROUP BY lower(source)), "
+    "bumped AS (UPDATE source SET serial = source.serial + counts.n "
+    "FROM counts WHERE lower(source.name) = counts.name "
+    "RETURNING source.name, source.serial - counts.n AS base) "
+    "INSERT INTO journal (source, serial, operation, class, key, object_id) "
+    "SELECT b.name, b.base + row_number() OVER "
+    "(PARTITION BY lower(s.source) ORDER BY s.seq), 'ADD', "
+    "lower(s.class), lower(s.key), s.object_id "
+    "FROM staging_object AS s JOIN bumped AS b "
+    "ON lower(b.name) = lower(s.source)",
+] + STAGING_FIELDS + [
+    "INSERT INTO route (object_id, address, asn) "
+    "SELECT DISTINCT ON (r.address, r.asn) s.object_id, r.address, r.asn "
+    "FROM staging_route AS r JOIN staging_object AS s USING (seq) "
+    "ORDER BY r.address, r.asn, r.seq DESC "
+    "ON CONFLICT (address, asn) DO UPDATE SET object_id = EXCLUDED.object_id",
+    "INSERT INTO inetnum (object_id, address) "
+    "SELECT DISTINCT ON (i.address) s.object_id, i.address "
+    "FROM staging_inetnum AS i JOIN staging_object AS s USING (seq) "
+    "ORDER BY i.address, i.seq DESC "
+    "ON CONFLICT (address) DO UPDATE SET object_id = EXCLUDED.object_id",
+    "INSERT INTO as_block (object_id, range) "
+    "SELECT DISTINCT ON (int8range(a.lower, a.upper, '[]')) s.object_id, "
+    "int8range(a.lower, a.upper, '[]') "
+    "FROM staging_as_block AS a JOIN staging_object AS s USING (seq) "
+    "ORDER BY int8range(a.lower, a.upper, '[]'), a.seq DESC "
+    "ON CONFLICT (range) DO UPDATE SET object_id = EXCLUDED.object_id",
+    "INSERT INTO domain (object_id, name) "
+    "SELECT DISTINCT ON (lower(d.name)) s.object_id, lower(d.name) "
+    "FROM staging_domain AS d JOIN staging_object AS s USING (seq) "
+    "ORDER BY lower(d.name), d.seq DESC "
+    "ON CONFLICT (name) DO UPDATE SET object_id = EXCLUDED.object_id",
+    "DELETE FROM inverse_field WHERE object_id IN "
+    "(SELECT object_id FROM staging_object)",
+    "INSERT INTO inverse_field (object_id, key, value) "
+    "SELECT DISTINCT s.object_id, i.key, i.value "
+    "FROM staging_inverse AS i JOIN staging_object AS s USING (seq) "
+    "ON CONFLICT DO NOTHING"
+]
+
+STAGING_MERGE_COMPACT = [statement for statement in STAGING_MERGE
+                         if statement not in STAGING_FIELDS] \
+    + STAGING_FIELDS_COMPACT
@@ -0,0 +1,162 @@
+# coding: utf-8
+
+import collections
+import threading
+import time
+
+import psycopg2 as pg
+import psycopg2.extensions
+import psycopg2.pool
+
+
+class ConnectionPool(object):
+    def __init__(self, minconn, maxconn, dsn, connect_options={},
+                 configure=None, timeout=None, check_interval=30.0,
+                 max_lifetime=None):
+        if minconn > maxconn:
+            raise ValueError("minconn must not be greater than maxconn")
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.dsn = dsn
+        self.timeout = timeout
+        self.check_interval = check_interval
+        self.max_lifetime = max_lifetime
+        self.closed = False
+        self._connect_options = connect_options
+        self._configure = configure
+        self._idle = collections.deque()
+        self._used = set()
+        self._created = {}
+        self._last_used = {}
+        self._connecting = 0
+        self._cond = threading.Condition()
+        for _ in range(minconn):
+            self._idle.append(self._connect())
+
+    # Network I/O (connecting, health checks, rollbacks and closing) never
+    # happens while self._cond is held, slots are reserved under the lock
+    # and released again when the I/O fails.
+
+    def _connect(self):
+        conn = pg.connect(self.dsn, **self._connect_options)
+        if self._configure is not None:
+            self._configure(conn)
+            conn.commit()
+        with self._cond:
+            self._created[conn] = self._last_used[conn] = time.monotonic()
+        return conn
+
+    def _discard(self, conn):
+        with self._cond:
+            self._created.pop(conn, None)
+            self._last_used.pop(conn, None)
+        try:
+            conn.close()
+        except pg.Error:
+            pass
+
+    def _usable(self, conn):
+        now = time.monotonic()
+        if conn.closed:
+            return False
+        if self.max_lifetime is not None \
+                and now - self._created[conn] > self.max_lifetime:
+            return False
+        if self.check_interval is not None \
+                and now - self._last_used[conn] > self.check_interval:
+            try:
+                with conn.cursor() as cur:
+                    cur.execute("SELECT 1")
+                conn.rollback()
+            except (pg.OperationalError, pg.InterfaceError):
+                return False
+        return True
+
+    def _reserve(self, deadline):
+        with self._cond:
+            while True:
+                if self.closed:
+                    raise pg.pool.PoolError("connection pool is closed")
+                if self._idle:
+                    conn = self._idle.pop()
+                    self._used.add(conn)
+                    return conn
+                if len(self._used) + self._connecting < self.maxconn:
+                    self._connecting += 1
+                    return None
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise pg.pool.PoolError("connection pool exhausted")
+                self._cond.wait(remaining)
+
+    def _release(self, conn=None):
+        with self._cond:
+            if conn is None:
+                self._connecting -= 1
+            else:
+                self._used.discard(conn)
+            self._cond.notify()
+
+    def getconn(self, key=None, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            conn = self._reserve(deadline)
+            if conn is not None:
+                if self._usable(conn):
+                    return conn
+                self._release(conn)
+                self._discard(conn)
+                continue
+            try:
+                conn = self._connect()
+            except BaseException:
+                self._release()
+                raise
+            with self._cond:
+                self._connecting -= 1
+                closed = self.closed
+                if not closed:
+                    self._used.add(conn)
+            if closed:
+                self._discard(conn)
+                raise pg.pool.PoolError("connection pool is closed")
+            return conn
+
+    def putconn(self, conn, key=None, close=False):
+        if not close and not self.closed and not conn.closed:
+            status = conn.info.transaction_status
+            if status == pg.extensions.TRANSACTION_STATUS_UNKNOWN:
+                close = True
+            elif status != pg.extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    conn.rollback()
+                except pg.Error:
+                    close = True
+        with self._cond:
+            self._used.discard(conn)
+            close = close or self.closed or conn.closed or \
+                len(self._idle) + len(self._used) >= self.maxconn
+            if not close:
+                self._last_used[conn] = time.monotonic()
+                self._idle.append(conn)
+            self._cond.notify()
+        if close:
+            self._discard(conn)
+
+    def closeall(self):
+        with self._cond:
+            self.closed = True
+            conns = list(self._idle) + list(self._used)
+            self._idle.clear()
+            self._used.clear()
+            self._cond.notify_all()
+        for conn in conns:
+            self._discard(conn)
+
+    @property
+    def size(self):
+        return len(self._idle) + len(self._used)
@@ -0,0 +1,254 @@
+# coding: utf-8
+
+import ipaddress
+import threading
+import time
+
+
+class _Node(object):
+    __slots__ = ("value", "length", "children", "entries")
+
+    def __init__(self, value, length, entries=None):
+        self.value = value
+        self.length = length
+        self.children = [None, None]
+        self.entries = entries if entries is not None else []
+
+
+class PrefixTree(object):
+    def __init__(self, bits):
+        self.bits = bits
+        self.root = _Node(0, 0)
+
+    def _mask(self, value, length):
+        if length == 0:
+            return 0
+        return value & (((1 << length) - 1) << (self.bits - length))
+
+    def _bit(self, value, position):
+        return (value >> (self.bits - position - 1)) & 1
+
+    def _common(self, a, b):
+        return self.bits - (a ^ b).bit_length()
+
+    def insert(self, value, length, entry):
+        value = self._mask(value, length)
+        node = self.root
+        while True:
+            if node.length == length:
+                node.entries.append(entry)
+                return
+            bit = self._bit(value, node.length)
+            child = node.children[bit]
+            if child is None:
+                node.children[bit] = _Node(value, length, [entry])
+                return
+            common = min(child.length, length,
+                         self._common(child.value, value))
+            if common == child.length:
+                node = child
+                continue
+            if common == length:
+                new = _Node(value, length, [entry])
+                new.children[self._bit(child.value, length)] = child
+                node.children[bit] = new
+                return
+            fork = _Node(self._mask(value, common), common)
+            fork.children[self._bit(child.value, common)] = child
+            fork.children[self._bit(value, common)] = _Node(
+                value, length, [entry])
+            node.children[bit] = fork
+            return
+
+    def remove(self, value, length, predicate):
+        value = self._mask(value, length)
+        node = self.root
+        while node is not None:
+            if node.length == length and node.value == value:
+                node.entries[:] = [e for e in node.entries
+                                   if not predicate(e)]
+                return
+            if node.length >= length:
+                return
+            node = node.children[self._bit(value, node.length)]
+            if node is not None and (node.length > length or
+                                     self._mask(value, node.length)
+                                     != node.value):
+                return
+
+    def covering(self, value, length):
+        value = self._mask(value, length)
+        node = self.root
+        while node is not None and node.length <= length \
+                and self._mask(value, node.length) == node.value:
+            if node.entries:
+                yield node.length, node.value, node.entries
+            if node.length == self.bits:
+                break
+            node = node.children[self._bit(value, node.length)]
+
+    def covered(self, value, length):
+        value = self._mask(value, length)
+        node = self.root
+        while node is not None and node.length < length:
+            if self._mask(value, node.length) != node.value:
+                return
+            node = node.children[self._bit(value, node.length)]
+        if node is None or self._mask(node.value, length) != value:
+            return
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            if node.entries:
+                yield node.length, node.value, node.entries
+            stack.extend(c for c in reversed(node.children) if c is not None)
+
+
+class PrefixIndex(object):
+    tables = {
+        "route": ("route", "route6"),
+        "inetnum": ("inetnum", "inet6num")
+    }
+
+    def __init__(self, refresh_interval=None):
+        self.refresh_interval = refresh_interval
+        self.serials = {}
+        self._trees = self._empty_trees()
+        self._specs = {}
+        self._lock = threading.RLock()
+        self._refresh_lock = threading.Lock()
+        self._last_refresh = None
+
+    def _empty_trees(self):
+        return {table: {4: PrefixTree(32), 6: PrefixTree(128)}
+                for table in self.tables}
+
+    def _add(self, table, address, class_, key, object_id, trees=None,
+             specs=None):
+        if trees is None:
+            trees, specs = self._trees, self._specs
+        net = ipaddress.ip_network(address)
+        spec = (class_.lower(), key.lower())
+        trees[table][net.version].insert(
+            int(net.network_address), net.prefixlen, (class_, key, object_id))
+        specs.setdefault(spec, []).append((table, net))
+
+    def _remove(self, class_, key):
+        spec = (class_.lower(), key.lower())
+        for table, net in self._specs.pop(spec, []):
+            self._trees[table][net.version].remove(
+                int(net.network_address), net.prefixlen,
+                lambda e: (e[0].lower(), e[1].lower()) == spec)
+
+    def _query(self, table, specs=None):
+        query = "SELECT {table}.address, object.class, object.key, " \
+                "object.id FROM {table} JOIN object " \
+                "ON object.id = {table}.object_id".format(table=table)
+        if specs is not None:
+            query += " WHERE (lower(object.class), lower(object.key)) IN %s"
+        return query
+
+    def load(self, database):
+        # The new index is built aside and swapped in once the scan has
+        # succeeded, lookups keep using the old one in the meantime
+        trees, specs = self._empty_trees(), {}
+        with self._refresh_lock, database.session(streaming=True) as sess:
+            with sess.conn.cursor() as cur:
+                cur.execute("SELECT name, serial FROM source")
+                serials = dict(cur)
+            for table in self.tables:
+                with sess._stream_cursor("prefix_index") as cur:
+                    cur.execute(self._query(table))
+                    for row in cur:
+                        self._add(table, *row, trees=trees, specs=specs)
+            with self._lock:
+                self._trees, self._specs = trees, specs
+                self.serials = serials
+                self._last_refresh = time.monotonic()
+
+    def refresh(self, database):
+        with self._refresh_lock:
+            self._refresh(database)
+
+    def _refresh(self, database):
+        changed = set()
+        serials = {}
+        with database.session() as sess:
+            with sess.conn.cursor() as cur:
+                cur.execute("SELECT name, serial FROM source")
+                sources = dict(cur)
+            for source, serial in sources.items():
+                last = self.serials.get(source, 0)
+                if serial <= last:
+                    continue
+                for _, _, class_, key in sess.changes_since(source, last):
+                    if any(class_.lower() in classes
+                           for classes in self.tables.values()):
+                        changed.add((class_.lower(), key.lower()))
+                serials[source] = serial
+            rows = {}
+            if changed:
+                for table in self.tables:
+                    with sess.conn.cursor() as cur:
+                        cur.execute(self._query(table, changed),
+                                    (tuple(changed),))
+                        rows[table] = cur.fetchall()
+        with self._lock:
+            for class_, key in changed:
+                self._remove(class_, key)
+            for table, table_rows in rows.items():
+                for row in table_rows:
+                    self._add(table, *row)
+            for source, serial in serials.items():
+                if serial > self.serials.get(source, 0):
+                    self.serials[source] = serial
+            self._last_refresh = time.monotonic()
+
+    def maybe_refresh(self, database):
+        if self.refresh_interval is None or self._last_refresh is None:
+            return
+        if time.monotonic() - self._last_refresh < self.refresh_interval:
+            return
+        # Lookups keep using the current snapshot while another thread
+        # is refreshing it
+        if not self._refresh_lock.acquire(blocking=False):
+            return
+        try:
+            if time.monotonic() - self._last_refresh >= \
+                    self.refresh_interval:
+                self._refresh(database)
+        finally:
+            self._refresh_lock.release()
+
+    def lookup_route(self, address, limit=None):
+        net = ipaddress.ip_network(address, strict=False)
+        with self._lock:
+            nodes = list(self._trees["route"][net.version].covering(
+                int(net.network_address), net.prefixlen))
+            results = [(e[0], e[1]) for _, _, entries in reversed(nodes)
+                       for e in entries]
+        return results[:limit] if limit is not None else results
+
+    def lookup_inetnum(self, address, relation='>>=', limit=None,
+                       order='DESC'):
+        if order not in {'ASC', 'DESC'}:
+            raise ValueError("{!r} is not a valid order, must be one "
+                             "of 'ASC' or 'DESC'".format(order))
+        if relation not in {'>>', '>>=', '<<', '<<='}:
+            raise ValueError("{!r} is not a valid relation, must be one "
+                             "of '>>', '>>=', '<<' or '<<='".format(relation))
+        net = ipaddress.ip_network(address, strict=False)
+        value, length = int(net.network_address), net.prefixlen
+        with self._lock:
+            tree = self._trees["inetnum"][net.version]
+            if relation in {'>>', '>>='}:
+                nodes = list(tree.covering(value, length))
+            else:
+                nodes = list(tree.covered(value, length))
+            if relation in {'>>', '<<'}:
+                nodes = [n for n in nodes if (n[0], n[1]) != (length, value)]
+            nodes.sort(key=lambda n: (n[0] if order == 'ASC' else -n[0],
+                                      n[1]))
+            results = [(e[0], e[1]) for _, _, entries in nodes
+                       for e in entries]
+        return results[:limit] if limit is not None else results
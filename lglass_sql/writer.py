@@ -0,0 +1,176 @@
+# coding: utf-8
+
+import collections
+import concurrent.futures
+import itertools
+import threading
+import time
+
+
+class WriteBehindQueue(object):
+    def __init__(self, database, batch_size=500, flush_interval=1.0,
+                 maxsize=10000):
+        if maxsize < batch_size:
+            raise ValueError("maxsize must not be less than batch_size")
+        self.database = database
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.maxsize = maxsize
+        self.closed = False
+        self.batches = 0
+        self.coalesced = 0
+        self._pending = collections.OrderedDict()
+        self._latest = {}
+        self._seq = itertools.count()
+        self._inflight = 0
+        self._flush_requested = False
+        self._oldest = None
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def save(self, obj, **options):
+        return self._enqueue("save", obj, options)
+
+    def delete(self, obj):
+        return self._enqueue("delete", obj, {})
+
+    def _enqueue(self, operation, obj, options):
+        spec = self.database.primary_spec(obj)
+        future = concurrent.futures.Future()
+        thread = threading.get_ident()
+        with self._cond:
+            while True:
+                if self.closed:
+                    raise RuntimeError("write-behind queue is closed")
+                # Only identical operations are coalesced, so that every
+                # future resolves to the result of a matching call
+                key = self._latest.get(spec)
+                if key is not None and self._pending[key][0] == operation \
+                        and self._pending[key][3] == options:
+                    _, _, futures, _, threads = self._pending.pop(key)
+                    self.coalesced += 1
+                    break
+                if len(self._pending) < self.maxsize:
+                    key = (spec, next(self._seq))
+                    futures, threads = [], set()
+                    break
+                self._cond.wait()
+            futures.append(future)
+            threads.add(thread)
+            self._pending[key] = (operation, obj, futures, options, threads)
+            self._latest[spec] = key
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+                self._cond.notify_all()
+            elif len(self._pending) >= self.batch_size:
+                self._cond.notify_all()
+        return future
+
+    def flush(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            self._flush_requested = True
+            self._cond.notify_all()
+            while self._pending or self._inflight:
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                self._cond.wait(remaining)
+        return True
+
+    def close(self, timeout=None):
+        with self._cond:
+            if self.closed:
+                return
+            self.closed = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
+
+    def __len__(self):
+        return len(self._pending)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _next_batch(self):
+        with self._cond:
+            while True:
+                if self._pending and (self.closed or self._flush_requested
+                                      or len(self._pending)
+                                      >= self.batch_size):
+                    break
+                if not self._pending:
+                    self._flush_requested = False
+                    if self.closed:
+                        return None
+                    self._cond.wait()
+                    continue
+                remaining = self._oldest + self.flush_interval \
+                    - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            batch = []
+            while self._pending and len(batch) < self.batch_size:
+                key, entry = self._pending.popitem(last=False)
+                if self._latest.get(key[0]) == key:
+                    del self._latest[key[0]]
+                batch.append(entry)
+            self._oldest = time.monotonic() if self._pending else None
+            self._inflight += len(batch)
+            self._cond.notify_all()
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            try:
+                self._write(batch)
+            finally:
+                with self._cond:
+                    self._inflight -= len(batch)
+                    self._cond.notify_all()
+
+    def _write(self, batch):
+        results = []
+        try:
+            with self.database.session() as sess:
+                with sess.conn.cursor() as cur:
+                    for operation, obj, futures, options, _ in batch:
+                        cur.execute("SAVEPOINT lglass_write_behind")
+                        try:
+                            if operation == "save":
+                                result = sess.save(obj, **options)
+                            else:
+                                result = sess.delete(obj)
+                        except Exception as err:
+                            cur.execute("ROLLBACK TO SAVEPOINT "
+                                        "lglass_write_behind")
+                            results.append((futures, None, err))
+                        else:
+                            cur.execute("RELEASE SAVEPOINT "
+                                        "lglass_write_behind")
+                            results.append((futures, result, None))
+                sess.commit()
+        except Exception as err:
+            for _, _, futures, _, _ in batch:
+                for future in futures:
+                    future.set_exception(err)
+            return
+        self.batches += 1
+        for thread in set().union(*(entry[4] for entry in batch)):
+            self.database._wrote(thread)
+        for futures, result, err in results:
+            for future in futures:
+                if err is not None:
+                    future.set_exception(err)
+                else:
+                    future.set_result(result)
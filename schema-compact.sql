@@ -0,0 +1,21 @@
+-- Compact storage layout, applied on top of schema.sql. Object lines are kept
+-- as an ordered two-dimensional text array in object.fields instead of one
+-- object_field row per line. Use with Database(..., storage="compact").
+--
+-- Every client of the database must switch to storage="compact" together:
+-- normalized clients do not read object.fields and would see stale or missing
+-- object lines. The object_field rows are kept, so the migration can be
+-- reverted with schema-normalized.sql. Once all clients have switched, they
+-- may be dropped with TRUNCATE object_field.
+
+BEGIN;
+
+ALTER TABLE object ADD COLUMN IF NOT EXISTS fields text[];
+
+-- Migrate objects stored in the normalized layout
+UPDATE object SET fields = ARRAY(
+	SELECT ARRAY[f.key::text, f.value] FROM object_field AS f
+	WHERE f.object_id = object.id ORDER BY f.position)
+	WHERE fields IS NULL;
+
+COMMIT;
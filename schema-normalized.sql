@@ -0,0 +1,17 @@
+-- Reverts schema-compact.sql, rebuilding object_field from object.fields.
+-- Every client must switch back to storage="normalized" afterwards.
+-- Positions are spaced by 1024 like lglass_sql.nic.POSITION_STEP.
+
+BEGIN;
+
+DELETE FROM object_field
+	WHERE object_id IN (SELECT id FROM object WHERE fields IS NOT NULL);
+
+INSERT INTO object_field (object_id, position, key, value)
+	SELECT object.id, (i - 1) * 1024, object.fields[i][1], object.fields[i][2]
+	FROM object, generate_subscripts(object.fields, 1) AS i
+	WHERE object.fields IS NOT NULL;
+
+UPDATE object SET fields = NULL WHERE fields IS NOT NULL;
+
+COMMIT;
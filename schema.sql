@@ -6,9 +6,12 @@ CREATE TABLE IF NOT EXISTS object (
 	key varchar not null,
 	source varchar,
 	created timestamp without time zone default NOW(),
-	last_modified timestamp without time zone default NOW()
+	last_modified timestamp without time zone default NOW(),
+	digest varchar
 );
 
+ALTER TABLE object ADD COLUMN IF NOT EXISTS digest varchar;
+
 CREATE INDEX IF NOT EXISTS object_idx_source ON object (lower(source));
 CREATE INDEX IF NOT EXISTS object_idx_class_key ON object (class, key);
 CREATE UNIQUE INDEX IF NOT EXISTS object_idx_class_key_lower
@@ -24,6 +27,8 @@ CREATE TABLE IF NOT EXISTS object_field (
 
 CREATE INDEX IF NOT EXISTS object_field_idx_object_id
 	ON object_field (object_id);
+CREATE INDEX IF NOT EXISTS object_field_idx_value
+	ON object_field USING HASH (value);
 
 CREATE OR REPLACE VIEW full_object (object_id, object_class, object_key,
 	object_source, object_created, object_last_modified, field_key, field_value,
@@ -67,19 +72,35 @@ CREATE TABLE IF NOT EXISTS inverse_field (
 
 CREATE INDEX IF NOT EXISTS inverse_field_idx_object_id
 	ON inverse_field (object_id);
-CREATE INDEX IF NOT EXISTS inverse_field_idx_key_value
-	ON inverse_field(key, value);
+DROP INDEX IF EXISTS inverse_field_idx_key_value;
+CREATE INDEX IF NOT EXISTS inverse_field_idx_key_value_object_id
+	ON inverse_field(key, value, object_id);
 
 CREATE TABLE IF NOT EXISTS source (
 	name varchar primary key,
 	serial integer default 0,
-	object_id integer not null references object(id) on delete cascade
+	object_id integer references object(id) on delete cascade
 );
 
+ALTER TABLE source ALTER COLUMN object_id DROP NOT NULL;
+
 CREATE UNIQUE INDEX IF NOT EXISTS source_idx_name_lower
 	ON source (lower(name));
 CREATE INDEX IF NOT EXISTS source_idx_name ON source (name);
 
+CREATE TABLE IF NOT EXISTS journal (
+	source varchar not null,
+	serial integer not null,
+	operation varchar not null,
+	class varchar not null,
+	key varchar not null,
+	object_id integer,
+	timestamp timestamp without time zone default NOW()
+);
+
+CREATE UNIQUE INDEX IF NOT EXISTS journal_idx_source_serial
+	ON journal (lower(source), serial);
+
 CREATE TABLE IF NOT EXISTS as_block (
 	object_id integer not null references object(id) on delete cascade,
 	range int8range unique not null
@@ -99,3 +120,12 @@ CREATE INDEX IF NOT EXISTS domain_idx_object_id ON domain (object_id);
 CREATE INDEX IF NOT EXISTS domain_idx_name_rev
 	ON domain (reverse(name) varchar_pattern_ops);
 
+
+CREATE TABLE IF NOT EXISTS rebuild_progress (
+	job varchar not null,
+	lower integer not null,
+	upper integer not null,
+	objects integer not null default 0,
+	finished timestamp without time zone default NOW(),
+	primary key (job, lower, upper)
+);
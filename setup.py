@@ -23,6 +23,9 @@ setuptools.setup(
         "lglass",
         "psycopg2"
     ],
+    extras_require={
+        "async": ["aiopg"]
+    },
     package_data={
     }
 )